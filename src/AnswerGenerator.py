@@ -1,35 +1,53 @@
 import numpy as np
 import utils
 import sys
+import heapq
+
+from PatternMatcher import PatternMatcher
 
 class AnswerGenerator:
+	# top_k is the max. number of patterns (the nearest ones) tried for each question,
+	# max_distance the max. Levenshtein distance of a pattern from the question to be
+	# tried (None to try all the patterns):
 	def __init__(self,
-				 knowledgeBase, question_patterns):
-		# Linear algorithm seems to work well with 1M elements
-		# but could be quicker with dictionaries:
+				 knowledgeBase, question_patterns,
+				 top_k=None, max_distance=None):
 		self.knowledgeBase = knowledgeBase
 	
 		self.question_patterns = question_patterns
+		self.pattern_matcher = PatternMatcher(question_patterns)
+		self.patterns = [q_p for r in question_patterns.relation_to_questions for q_p in question_patterns[r]]
+
+		self.top_k = top_k
+		self.max_distance = max_distance
+
+		# Number of answers found with the pattern matcher ("pattern"), with
+		# the pattern at rank 1..k ("rank k") or not found at all ("none"),
+		# useful to tune top_k:
+		self.answer_rank_counts = {}
 
 	def generate(self, question, babelNetCache):
-		#min_d = sys.maxsize
-		Q = []
-		l = []
-		for r in self.question_patterns.relation_to_questions:
-			for q_p in self.question_patterns[r]:
-				d = utils.levenshtein(question, q_p)
-				q_p_pos = len(l)
-				for k in range(len(l)):
-					if d <= l[k]:
-						q_p_pos = k
-						break
-				Q.insert(q_p_pos, q_p)
-				l.insert(q_p_pos, d)
+		# Try first the patterns matching the question:
+		for relation, conceptX, conceptY in self.pattern_matcher.match(question):
+			answer = self._search_answer(babelNetCache, conceptX, conceptY)
+			if answer is not None:
+				self._count_answer_rank("pattern")
+				return answer
+
+		# Rank all the patterns using Levenshtein distance otherwise:
+		distances = utils.levenshtein_many(question, self.patterns, self.max_distance)
+		candidates = range(len(self.patterns))
+		if self.max_distance is not None:
+			candidates = [i for i in candidates if distances[i] <= self.max_distance]
 
-		# Consider first best T matches:
-		T = len(Q)
+		# Nearest patterns first (the last in the file first if equally distant):
+		key = lambda i: (distances[i], -i)
+		if self.top_k is not None:
+			Q = [self.patterns[i] for i in heapq.nsmallest(self.top_k, candidates, key=key)]
+		else:
+			Q = [self.patterns[i] for i in sorted(candidates, key=key)]
 
-		for q in Q[:T]:
+		for rank, q in enumerate(Q, 1):
 			#print(q)
 			Xpos = q.find("X")
 			Ypos = q.find("Y")
@@ -138,60 +156,23 @@ class AnswerGenerator:
 				conceptY = question[concept_begin_idx:concept_end_idx].lower()
 				#print("conceptY:", conceptY)
 				
-			for elem in self.knowledgeBase.kb:
-				matchX = False
-				matchY = False
-			
-				# X in the question:
-				if Xpos != -1:
-					c1 = elem["c1"]
-					if c1.count("bn:") >= 2:
-						pass
-					elif "::" in c1:
-						idx = c1.index("::")
-						w = c1[:idx].lower()
-						if conceptX == w:
-							matchX = True
-					elif "bn:" in c1:
-						try:
-							bn_conceptx = babelNetCache.cache[c1[c1.index("bn:"):]].lower()
-							#print("bn_conceptx:", bn_conceptx)
-							if conceptX == bn_conceptx:
-								matchX = True
-						except:
-							pass
-					elif c1.lower() == conceptX:
-						matchX = True
+			answer = self._search_answer(babelNetCache,
+										 conceptX if Xpos != -1 else None,
+										 conceptY if Ypos != -1 else None)
+			if answer is not None:
+				self._count_answer_rank("rank " + str(rank))
+				return answer
 
-				# Y in the question:
-				if Ypos != -1:
-					c2 = elem["c2"]
-					if c2.count("bn:") >= 2:
-						pass
-					elif "::" in c2:
-						idx = c2.index("::")
-						w = c2[:idx].lower()
-						if conceptY == w:
-							matchY = True
-					elif "bn:" in c2:
-						try:
-							bn_concepty = babelNetCache.cache[c2[c2.index("bn:"):]].lower()
-							#print("bn_concepty:", bn_concepty)
-							if conceptY == bn_concepty:
-								matchY = True
-						except:
-							pass
-					elif c2.lower() == conceptY:
-						matchY = True
+		self._count_answer_rank("none")
+		return "I don't understand."
 
-				if Xpos != -1 and Ypos != -1:
-					if matchX == True and matchY == True:
-						#print("XY - Match found with:")
-						#print(elem)
-						return elem["answer"]
-				elif matchX == True or matchY == True:
-					#print("Match found with:")
-					#print(elem)
-					return elem["answer"]
+	def _count_answer_rank(self, rank):
+		if rank not in self.answer_rank_counts:
+			self.answer_rank_counts[rank] = 0
+		self.answer_rank_counts[rank] += 1
 
-		return "I don't understand."
+	# Search for the answer of the first element of the KB whose c1 is conceptX
+	# and whose c2 is conceptY (None if the concept is not in the question):
+	def _search_answer(self, babelNetCache, conceptX, conceptY):
+		elem = self.knowledgeBase.search_exact(babelNetCache, conceptX, conceptY)
+		return elem["answer"] if elem is not None else None
@@ -1,34 +1,199 @@
+from collections import OrderedDict
 from pathlib import Path
+import os
+import threading
+import time
+
+# Dict with at most max_size elements, when it's full the least
+# recently used element is removed:
+class LRUDict(OrderedDict):
+	def __init__(self, max_size):
+		super(LRUDict, self).__init__()
+		self.max_size = max_size
+		self.evictions = 0
+
+	def __getitem__(self, key):
+		value = super(LRUDict, self).__getitem__(key)
+		self.move_to_end(key)
+		return value
+
+	def __setitem__(self, key, value):
+		super(LRUDict, self).__setitem__(key, value)
+		self.move_to_end(key)
+		if len(self) > self.max_size:
+			self.popitem(last=False)
+			self.evictions += 1
 
 # Cache babelnetid-lemma to reduce the queries to BabelNet (save babelcoins),
-# speed up the training of concept_extractor.keras and the generation of questions:
+# speed up the training of concept_extractor.keras and the generation of questions.
+# In persistent mode the elements added to the cache are appended to a log file
+# (cache_file_path + ".log") by a background thread every flush_interval seconds,
+# so they are not lost when the program is restarted, compact() merges the log
+# into the cache file (don't compact a bounded cache, evicted elements would be lost).
+# If max_size is specified the cache keeps only the max_size most recently used
+# elements, the babelNetIDs that BabelNet can't resolve are remembered for
+# negative_ttl seconds:
 class BabelNetCache:
-	def __init__(self, cache_file_path):
-		self.cache = {}
+	def __init__(self, cache_file_path, persistent=False, flush_interval=10,
+				 max_size=None, negative_ttl=3600):
+		self.cache = LRUDict(max_size) if max_size is not None else {}
 		self.cache_file_path = cache_file_path
-		
-		if Path(self.cache_file_path).is_file():
-			cache_file = open(self.cache_file_path)
-			lines = cache_file.readlines()
-			cache_file_len = len(lines)
-			print("Reading " + self.cache_file_path + " (" + str(cache_file_len) + " elements)")
-			cnt = 0
-			
-			for elem in lines:
-				cnt += 1
-				print("Progress: {:2.1%}".format(cnt / cache_file_len), end="\r")
-				elem = elem.split("\t")
-				self.cache[elem[0]] = elem[1].rstrip("\n")
+		self.log_file_path = cache_file_path + ".log"
+		self.persistent = persistent
+
+		# babelNetID -> expiration time of the negative element:
+		self.negative_cache = {}
+		self.negative_ttl = negative_ttl
+
+		# Counters of get():
+		self.hits = 0
+		self.misses = 0
+		self.negative_hits = 0
+
+		self._read(self.cache_file_path)
+		self._read(self.log_file_path, is_log=True)
+
+		# Incremented every time an element is added (used by KnowledgeBase
+		# to know if there are new elements, len(cache) doesn't change when
+		# the cache is full):
+		self.version = len(self.cache)
+
+		# Elements added but not written yet to the log:
+		self._pending = []
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._flush_interval = flush_interval
+		self._flush_thread = None
+
+		if self.persistent:
+			self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+			self._flush_thread.start()
+
+	# Return the lemma of the babelNetID, None if it's not in the cache:
+	def get(self, babelnetid):
+		try:
+			lemma = self.cache[babelnetid]
+			self.hits += 1
+			return lemma
+		except KeyError:
+			self.misses += 1
+			return None
+
+	# True if the babelNetID couldn't be resolved in the last negative_ttl seconds:
+	def is_negative(self, babelnetid):
+		expiration = self.negative_cache.get(babelnetid)
+		if expiration is None:
+			return False
+		if expiration < time.time():
+			del self.negative_cache[babelnetid]
+			return False
+		self.negative_hits += 1
+		return True
+
+	# Remember that the babelNetID can't be resolved (for negative_ttl seconds):
+	def add_negative(self, babelnetid):
+		self.negative_cache[babelnetid] = time.time() + self.negative_ttl
+
+	def stats(self):
+		return {
+			"size": len(self.cache),
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / max(self.hits + self.misses, 1),
+			"negative_hits": self.negative_hits,
+			"negative_size": len(self.negative_cache),
+			"evictions": self.cache.evictions if isinstance(self.cache, LRUDict) else 0
+		}
+
+	# Add an element to the cache (and to the log in persistent mode):
+	def add(self, babelnetid, lemma):
+		self.cache[babelnetid] = lemma
+		self.negative_cache.pop(babelnetid, None)
+		self.version += 1
+		if self.persistent:
+			with self._lock:
+				self._pending.append((babelnetid, lemma))
 
-			print("\nDone.")
-			cache_file.close()
+	# Write the pending elements at the end of the log:
+	def flush(self):
+		with self._lock:
+			pending = self._pending
+			self._pending = []
+		if not pending:
+			return
+
+		with open(self.log_file_path, "a", encoding="utf-8") as log_file:
+			for babelnetid, lemma in pending:
+				log_file.write(babelnetid + "\t" + lemma + "\n")
+			log_file.flush()
+			os.fsync(log_file.fileno())
+
+	# Stop the background thread writing the pending elements:
+	def close(self):
+		if self._flush_thread is not None:
+			self._stop.set()
+			self._flush_thread.join()
+			self._flush_thread = None
+		self.flush()
+
+	# Rewrite the cache file with all the elements and remove the log:
+	def compact(self):
+		self.flush()
+		tmp_file_path = self.cache_file_path + ".tmp"
+		self.save(tmp_file_path)
+		os.replace(tmp_file_path, self.cache_file_path)
+		if Path(self.log_file_path).is_file():
+			os.remove(self.log_file_path)
 
 	def save(self, cache_file_path=None):
-		
+
 		if cache_file_path is None:
 			cache_file_path = self.cache_file_path
-		
-		cache_file = open(cache_file_path, "w")
+
+		cache_file = open(cache_file_path, "w", encoding="utf-8")
 		for babelnetid, lemma in self.cache.items():
 			cache_file.write(babelnetid + "\t" + lemma + "\n")
 		cache_file.close()
+
+	def _flush_loop(self):
+		while not self._stop.wait(self._flush_interval):
+			self.flush()
+
+	def _read(self, file_path, is_log=False):
+		if not Path(file_path).is_file():
+			return
+
+		cache_file_len = os.path.getsize(file_path)
+		print("Reading " + file_path + " (" + str(cache_file_len) + " bytes)")
+		read_len = 0
+		cnt = 0
+
+		with open(file_path, "rb") as cache_file:
+			for elem in cache_file:
+				# The last line of the log could be incomplete (e.g. the program crashed),
+				# it's removed so that the next elements are appended correctly:
+				if is_log and not elem.endswith(b"\n"):
+					if self.persistent:
+						os.truncate(file_path, read_len)
+					break
+
+				read_len += len(elem)
+				cnt += 1
+				if cnt % 100000 == 0:
+					print("Progress: {:2.1%}".format(read_len / cache_file_len), end="\r")
+				elem = elem.decode("utf-8").rstrip("\n").split("\t")
+				self.cache[elem[0]] = elem[1]
+
+		print("\nDone (" + str(cnt) + " elements).")
+
+# Lemmas of a BabelNetCache which can't change (e.g. shared with other processes):
+# the babelNetIDs not in the cache are negative, so babelNetIdToLemma never queries BabelNet:
+class ReadOnlyBabelNetCache:
+	def __init__(self, babelNetCache):
+		self.cache = babelNetCache.cache
+
+	def get(self, babelnetid):
+		return self.cache.get(babelnetid)
+
+	def is_negative(self, babelnetid):
+		return babelnetid not in self.cache
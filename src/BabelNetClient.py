@@ -0,0 +1,235 @@
+import asyncio
+import gzip
+import json
+import ssl
+import threading
+import urllib.parse
+
+import utils
+
+class BabelNetError(Exception):
+	pass
+
+class BabelNetTimeout(BabelNetError):
+	pass
+
+# Minimal asyncio HTTP/1.1 client (GET only) keeping the connections
+# alive and reusing them, at most max_connections are open at the same time:
+class HTTPConnectionPool:
+	def __init__(self, max_connections=8):
+		self.max_connections = max_connections
+		self._semaphore = None
+		self._idle = {} # (scheme, host, port) -> list of (reader, writer)
+		self._ssl_context = ssl.create_default_context()
+
+	# The timeout (if not None) starts when a connection is available, so the
+	# time spent waiting for one of the max_connections isn't counted:
+	async def get(self, url, headers=None, timeout=None):
+		# The semaphore must be created inside the event loop:
+		if self._semaphore is None:
+			self._semaphore = asyncio.Semaphore(self.max_connections)
+
+		url = urllib.parse.urlsplit(url)
+		port = url.port or (443 if url.scheme == "https" else 80)
+		key = (url.scheme, url.hostname, port)
+		path = (url.path or "/") + ("?" + url.query if url.query else "")
+
+		request = "GET " + path + " HTTP/1.1\r\nHost: " + url.netloc + "\r\n"
+		request += "Accept-Encoding: gzip\r\nConnection: keep-alive\r\n"
+		for name, value in (headers or {}).items():
+			request += name + ": " + value + "\r\n"
+		request = (request + "\r\n").encode("latin-1")
+
+		async with self._semaphore:
+			status, response_headers, body = await asyncio.wait_for(self._request(key, request), timeout)
+
+		if response_headers.get("content-encoding") == "gzip":
+			body = gzip.decompress(body)
+		return status, body
+
+	async def close(self):
+		for connections in self._idle.values():
+			for reader, writer in connections:
+				writer.close()
+		self._idle = {}
+
+	async def _request(self, key, request):
+		# A connection kept alive could have been closed by the server,
+		# in that case try again once with a new connection:
+		for reuse in (True, False):
+			reader, writer, reused = await self._connect(key, reuse)
+			try:
+				writer.write(request)
+				await writer.drain()
+				status, response_headers, body, keep_alive = await self._read_response(reader)
+			except (ConnectionError, asyncio.IncompleteReadError):
+				writer.close()
+				if reused:
+					continue
+				raise
+			except BaseException:
+				# e.g. timeout: the connection is in an unknown state
+				writer.close()
+				raise
+
+			if keep_alive:
+				self._idle.setdefault(key, []).append((reader, writer))
+			else:
+				writer.close()
+			return status, response_headers, body
+
+	async def _connect(self, key, reuse):
+		if reuse and self._idle.get(key):
+			reader, writer = self._idle[key].pop()
+			return reader, writer, True
+		scheme, host, port = key
+		reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context if scheme == "https" else None)
+		return reader, writer, False
+
+	async def _read_response(self, reader):
+		status_line = await reader.readuntil(b"\r\n")
+		status = int(status_line.split()[1])
+		headers = {}
+		while True:
+			line = await reader.readuntil(b"\r\n")
+			if line == b"\r\n":
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+
+		keep_alive = headers.get("connection", "").lower() != "close" and not status_line.startswith(b"HTTP/1.0")
+		if headers.get("transfer-encoding", "").lower() == "chunked":
+			body = b""
+			while True:
+				size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+				chunk = await reader.readexactly(size + 2)
+				if size == 0:
+					break
+				body += chunk[:-2]
+		elif "content-length" in headers:
+			body = await reader.readexactly(int(headers["content-length"]))
+		else:
+			body = await reader.read()
+			keep_alive = False
+
+		return status, headers, body, keep_alive
+
+# Asynchronous client of BabelNet and Babelfy, every call is retried (with exponential
+# backoff) on network errors and server errors, every attempt fails after timeout seconds
+# (counted from when it gets one of the max_connections) and the whole call (waiting for
+# a connection, attempts and backoff included) fails after deadline seconds. Lemmas and
+# the results of Babelfy are read from/added to the caches if specified (the babelNetIDs
+# that time out aren't added to the negative cache, they can be resolved later):
+class BabelNetClient:
+	def __init__(self, babelNetCache=None, babelfyCache=None,
+				 babelnet_url="https://babelnet.io/v4/", babelfy_url="https://babelfy.io/v1/",
+				 key=utils.BABELNET_KEY,
+				 max_connections=8, timeout=10, retries=3, backoff=0.5, deadline=30):
+		self.babelNetCache = babelNetCache
+		self.babelfyCache = babelfyCache
+		self.babelnet_url = babelnet_url
+		self.babelfy_url = babelfy_url
+		self.key = key
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.deadline = deadline
+		self.pool = HTTPConnectionPool(max_connections)
+
+	# Return the lemma of the babelNetID (as utils.babelNetIdToLemma):
+	async def get_lemma(self, babelNetID):
+		if self.babelNetCache is not None:
+			lemma = self.babelNetCache.get(babelNetID)
+			if lemma is not None:
+				return lemma
+			if self.babelNetCache.is_negative(babelNetID):
+				raise LookupError(babelNetID + " can't be resolved by BabelNet")
+
+		try:
+			data = await self._get_json(self.babelnet_url + "getSynset", {"id": babelNetID, "key": self.key})
+			lemma = str(data["senses"][0].get("lemma")).replace("_", " ")
+		except BabelNetTimeout:
+			raise
+		except Exception:
+			if self.babelNetCache is not None:
+				self.babelNetCache.add_negative(babelNetID)
+			raise
+
+		if self.babelNetCache is not None:
+			self.babelNetCache.add(babelNetID, lemma)
+		return lemma
+
+	# Return a dict babelNetID -> lemma (None if it can't be resolved)
+	# querying concurrently BabelNet. At most max_connections lookups are
+	# started at the same time, so their deadline doesn't run out while
+	# they wait for a connection:
+	async def get_lemmas(self, babelNetIDs):
+		pending = iter(set(babelNetIDs))
+		lemmas = {}
+
+		async def lookup():
+			for babelNetID in pending:
+				try:
+					lemmas[babelNetID] = await self.get_lemma(babelNetID)
+				except Exception:
+					lemmas[babelNetID] = None
+
+		await asyncio.gather(*[lookup() for _ in range(self.pool.max_connections)])
+		return lemmas
+
+	# Return the results of Babelfy for the sentence:
+	async def disambiguate(self, sentence):
+		return await self._get_json(self.babelfy_url + "disambiguate", {"text": sentence, "lang": "EN", "key": self.key})
+
+	# Same as utils.babelfy_disambiguate:
+	async def disambiguate_span(self, sentence, concept_start, concept_end):
+		fragments = self.babelfyCache.get_fragments(sentence) if self.babelfyCache is not None else None
+		if fragments is None:
+			fragments = utils.babelfy_fragments(await self.disambiguate(sentence))
+			if self.babelfyCache is not None:
+				self.babelfyCache.add_fragments(sentence, fragments)
+		return utils.babelfy_span(sentence, fragments, concept_start, concept_end)
+
+	async def close(self):
+		await self.pool.close()
+
+	async def _get_json(self, url, params):
+		url = url + "?" + urllib.parse.urlencode(params)
+		try:
+			return await asyncio.wait_for(self._get_json_retrying(url), self.deadline)
+		except asyncio.TimeoutError:
+			raise BabelNetTimeout("Deadline (" + str(self.deadline) + "s) exceeded querying " + url)
+
+	async def _get_json_retrying(self, url):
+		attempt = 0
+		while True:
+			try:
+				status, body = await self.pool.get(url, timeout=self.timeout)
+				if status == 200:
+					return json.loads(body.decode("utf-8"))
+				error = BabelNetError("HTTP " + str(status) + " from " + url)
+				# Client errors (except too many requests) are not retried:
+				if status < 500 and status != 429:
+					raise error
+			except asyncio.TimeoutError:
+				# (checked first since it's a subclass of OSError)
+				raise BabelNetTimeout("Timeout (" + str(self.timeout) + "s) querying " + url)
+			except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+				error = e
+
+			attempt += 1
+			if attempt > self.retries:
+				raise error
+			await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+# Event loop running in a daemon thread, used to call the coroutines
+# of the client from synchronous code (e.g. the Telegram handler):
+class BackgroundLoop:
+	def __init__(self):
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+
+	# Run the coroutine in the loop and wait for its result:
+	def run(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
@@ -0,0 +1,22 @@
+import json
+
+from BabelNetCache import BabelNetCache
+
+# Cache of the results of Babelfy (the token fragments with their babelSynsetID)
+# for every sentence, so any span of a sentence already disambiguated can be
+# resolved without querying Babelfy again. The sentences are normalized
+# (lowercase, single spaces) without changing the indices of their tokens,
+# persistence, size bound and statistics work as in BabelNetCache:
+class BabelfyCache(BabelNetCache):
+	# Return the list of (start, end, babelSynsetID) of the sentence, None if it's not in the cache:
+	def get_fragments(self, sentence):
+		fragments = self.get(normalize_sentence(sentence))
+		if fragments is None:
+			return None
+		return [tuple(fragment) for fragment in json.loads(fragments)]
+
+	def add_fragments(self, sentence, fragments):
+		self.add(normalize_sentence(sentence), json.dumps([list(fragment) for fragment in fragments], ensure_ascii=False))
+
+def normalize_sentence(sentence):
+	return " ".join(sentence.lower().split())
@@ -0,0 +1,95 @@
+from concurrent.futures import Future
+import queue
+import threading
+
+import numpy as np
+
+# Run the predictions of a model (Keras or Seq2Seq) in micro-batches: the requests made at the
+# same time (e.g. by different chats) are collected for at most max_wait seconds
+# (or until max_batch_size samples), joined into a single batch and predicted with
+# a single call of model.predict, then every request gets its part of the results.
+# The samples of a request are the rows of its input (as model.predict), sequences
+# of different length are padded with 0 at the end (padding="post", masked by the
+# Keras models of the bot) or at the beginning (padding="pre") and the outputs with
+# a time dimension are cut back to the original length:
+class BatchPredictor:
+	def __init__(self, model, graph=None, max_batch_size=64, max_wait=0.005, padding="post"):
+		self.model = model
+		self.graph = graph
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.padding = padding
+
+		# Counters of the calls of model.predict:
+		self.requests = 0
+		self.batches = 0
+
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	# Same as model.predict(x) (can be called from many threads at the same time):
+	def predict(self, x):
+		future = Future()
+		self._queue.put((np.asarray(x), future))
+		return future.result()
+
+	def stats(self):
+		return {
+			"requests": self.requests,
+			"batches": self.batches,
+			"mean_batch_requests": self.requests / max(self.batches, 1)
+		}
+
+	def _run(self):
+		while True:
+			requests = [self._queue.get()]
+			n_samples = len(requests[0][0])
+			try:
+				while n_samples < self.max_batch_size:
+					request = self._queue.get(timeout=self.max_wait) if self.max_wait > 0 else self._queue.get_nowait()
+					requests.append(request)
+					n_samples += len(request[0])
+			except queue.Empty:
+				pass
+
+			try:
+				results = self._predict_batch([x for x, _ in requests])
+			except Exception as e:
+				for _, future in requests:
+					future.set_exception(e)
+				continue
+			for (_, future), result in zip(requests, results):
+				future.set_result(result)
+
+	def _predict_batch(self, inputs):
+		self.requests += len(inputs)
+		self.batches += 1
+
+		# Pad the sequences to the longest one:
+		lengths = [x.shape[1] if x.ndim > 1 else None for x in inputs]
+		max_length = max(lengths) if None not in lengths else None
+		if max_length is not None and len(set(lengths)) > 1:
+			padded_inputs = []
+			for x in inputs:
+				padding = [(0, 0)] * x.ndim
+				padding[1] = (0, max_length - x.shape[1]) if self.padding == "post" else (max_length - x.shape[1], 0)
+				padded_inputs.append(np.pad(x, padding, "constant"))
+			inputs = padded_inputs
+
+		batch = np.concatenate(inputs)
+		if self.graph is not None:
+			with self.graph.as_default():
+				outputs = self.model.predict(batch, batch_size=len(batch))
+		else:
+			outputs = self.model.predict(batch, batch_size=len(batch))
+
+		results = []
+		start = 0
+		for x, length in zip(inputs, lengths):
+			output = outputs[start:start+len(x)]
+			if length is not None and length != max_length and output.ndim > 2 and output.shape[1] == max_length:
+				output = output[:, :length] if self.padding == "post" else output[:, max_length-length:]
+			results.append(output)
+			start += len(x)
+		return results
@@ -0,0 +1,50 @@
+import asyncio
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Dispatch the messages of the bot in an asyncio event loop: the messages of different
+# chats are handled concurrently, the messages of the same chat are handled one at a
+# time in the order they have been received. The handler is blocking (NN inference,
+# KB search, queries to BabelNet/Babelfy...) so it runs in a pool of max_workers threads,
+# the event loop only keeps the queues of the chats:
+class ChatDispatcher:
+	def __init__(self, handler, loop, max_workers=8, chat_id=lambda msg: msg["chat"]["id"]):
+		self.handler = handler
+		self.loop = loop
+		self.executor = ThreadPoolExecutor(max_workers)
+		self.chat_id = chat_id
+		self.queues = {} # chat id -> messages to handle (only chats with pending messages)
+		self.processed = 0
+		self.errors = 0
+
+	# Add a message to the queue of its chat (can be called from any thread,
+	# e.g. as the handler of telepot's MessageLoop):
+	def submit(self, msg):
+		self.loop.call_soon_threadsafe(self._dispatch, msg)
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+
+	# (Runs in the event loop)
+	def _dispatch(self, msg):
+		chat_id = self.chat_id(msg)
+		if chat_id in self.queues:
+			self.queues[chat_id].append(msg)
+		else:
+			self.queues[chat_id] = deque([msg])
+			self.loop.create_task(self._handle_chat(chat_id))
+
+	# Handle the messages of a chat until its queue is empty:
+	async def _handle_chat(self, chat_id):
+		queue = self.queues[chat_id]
+		while queue:
+			msg = queue.popleft()
+			try:
+				await self.loop.run_in_executor(self.executor, self.handler, msg)
+			except Exception:
+				# An error must not stop the following messages of the chat:
+				self.errors += 1
+				traceback.print_exc()
+			self.processed += 1
+		del self.queues[chat_id]
@@ -0,0 +1,169 @@
+import json
+from array import array
+
+# Keys of the elements of the KB with few distinct values (stored once):
+INTERNED_KEYS = ("relation", "context", "domains")
+
+# Parse the elements of the KB (a JSON list of objects) one at a time
+# reading the file in chunks, without loading the whole JSON in memory:
+def iter_kb_items(kb_path, chunk_size=1 << 20):
+	decoder = json.JSONDecoder()
+	with open(kb_path, encoding="utf-8") as kb_file:
+		buf = ""
+		pos = 0
+		eof = False
+		started = False
+
+		while True:
+			# Skip whitespaces and separators (reading more data if needed):
+			while pos < len(buf) and (buf[pos].isspace() or buf[pos] == "," or (buf[pos] == "[" and not started)):
+				started = started or buf[pos] == "["
+				pos += 1
+			if pos == len(buf):
+				if eof:
+					raise ValueError("Unexpected end of " + kb_path)
+				buf = kb_file.read(chunk_size)
+				pos = 0
+				eof = len(buf) < chunk_size
+				continue
+			if buf[pos] == "]":
+				return
+
+			try:
+				item, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				# Element truncated by the end of the chunk:
+				more = kb_file.read(chunk_size)
+				eof = len(more) < chunk_size
+				buf = buf[pos:] + more
+				pos = 0
+				continue
+
+			yield item
+			pos = end
+
+# Column of strings stored as a single UTF-8 buffer plus offsets:
+# (data and offsets can be read-only buffers, e.g. a memory-mapped snapshot):
+class StringColumn:
+	def __init__(self, data=None, offsets=None):
+		self.data = data if data is not None else bytearray()
+		self.offsets = offsets if offsets is not None else array("Q", [0])
+
+	def append(self, s):
+		self.data += s.encode("utf-8")
+		self.offsets.append(len(self.data))
+
+	def __getitem__(self, i):
+		return str(self.data[self.offsets[i]:self.offsets[i+1]], "utf-8")
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+# Column of values with few distinct values, every value is stored
+# once and the column contains only its code:
+class InternedColumn:
+	def __init__(self, values=None, codes=None):
+		self.values = values if values is not None else []
+		self.value_to_code = {key: code for code, key in enumerate(self.values)}
+		self.codes = codes if codes is not None else array("I")
+
+	def append(self, value):
+		# Strings are used as keys directly, other values (e.g. lists) as JSON:
+		key = value if isinstance(value, str) else (json.dumps(value, sort_keys=True),)
+		code = self.value_to_code.get(key)
+		if code is None:
+			code = self.value_to_code[key] = len(self.values)
+			self.values.append(key)
+		self.codes.append(code)
+
+	def __getitem__(self, i):
+		key = self.values[self.codes[i]]
+		# Decoded every time so lists (e.g. domains) are never shared:
+		return key if isinstance(key, str) else json.loads(key[0])
+
+	def __len__(self):
+		return len(self.codes)
+
+# Storage of the elements of the KB column-wise, every element has a schema
+# (the tuple of its keys), values which are not strings of a string column are
+# stored apart (the column contains an empty string for them):
+class KBColumns:
+	def __init__(self):
+		self.n = 0
+		self.columns = {}
+		self.schemas = []
+		self.schema_to_code = {}
+		self.schema_codes = array("I")
+		self.others = {} # (element index, key) -> value
+
+	def append(self, item):
+		schema = tuple(item.keys())
+		if schema not in self.schema_to_code:
+			self.schema_to_code[schema] = len(self.schemas)
+			self.schemas.append(schema)
+		self.schema_codes.append(self.schema_to_code[schema])
+
+		for key in schema:
+			if key not in self.columns:
+				self._add_column(key)
+		for key, column in self.columns.items():
+			value = item.get(key, "")
+			if value.__class__ is not str and column.__class__ is StringColumn:
+				self.others[(self.n, key)] = value
+				value = ""
+			column.append(value)
+
+		self.n += 1
+
+	def element(self, i):
+		elem = {}
+		for key in self.schemas[self.schema_codes[i]]:
+			if (i, key) in self.others:
+				elem[key] = self.others[(i, key)]
+			else:
+				elem[key] = self.columns[key][i]
+		return elem
+
+	def value(self, i, key):
+		if key not in self.schemas[self.schema_codes[i]]:
+			raise KeyError(key)
+		if (i, key) in self.others:
+			return self.others[(i, key)]
+		return self.columns[key][i]
+
+	def _add_column(self, key):
+		column = InternedColumn() if key in INTERNED_KEYS else StringColumn()
+		# Back-fill the elements read before the key appeared:
+		for _ in range(self.n):
+			column.append("")
+		self.columns[key] = column
+
+# Read-only list of the elements of the KB (dicts built on access),
+# loaded with a streaming parser into a compact columnar representation:
+class CompactKnowledgeBase:
+	def __init__(self, kb_path=None, columns=None, ids=None):
+		if columns is None:
+			columns = KBColumns()
+			for item in iter_kb_items(kb_path):
+				columns.append(item)
+		self._columns = columns
+		self._ids = ids if ids is not None else range(columns.n)
+
+	def __len__(self):
+		return len(self._ids)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return CompactKnowledgeBase(columns=self._columns, ids=self._ids[i])
+		return self._columns.element(self._ids[i])
+
+	def __iter__(self):
+		for i in self._ids:
+			yield self._columns.element(i)
+
+	# Iterate over the values of a key without building the elements:
+	def iter_column(self, key):
+		for i in self._ids:
+			yield self._columns.value(i, key)
@@ -0,0 +1,49 @@
+import heapq
+from bisect import insort
+
+# Index of the concepts of one side (c1 or c2) of a relation,
+# maps every lemma to the (sorted) indices of the elements of the KB
+# having that lemma, a trigram index over the lemmas is used to find
+# quickly the lemmas containing a given concept:
+class ConceptIndex:
+	def __init__(self):
+		self.lemma_to_ids = {}
+		self.trigram_to_lemmas = {}
+
+	# Add the element with index elem_id and the given lemma:
+	def add(self, lemma, elem_id):
+		if lemma not in self.lemma_to_ids:
+			self.lemma_to_ids[lemma] = []
+			for t in self._trigrams(lemma):
+				if t not in self.trigram_to_lemmas:
+					self.trigram_to_lemmas[t] = set()
+				self.trigram_to_lemmas[t].add(lemma)
+		insort(self.lemma_to_ids[lemma], elem_id)
+
+	# Return the (sorted) indices of the elements having the lemma:
+	def ids_for_lemma(self, lemma):
+		return self.lemma_to_ids.get(lemma, ())
+
+	# Return an iterator over the (sorted) indices of the elements
+	# whose lemma contains the concept:
+	def ids_containing(self, concept):
+		if len(concept) >= 3:
+			candidates = None
+			for t in sorted(self._trigrams(concept), key=lambda t: len(self.trigram_to_lemmas.get(t, ()))):
+				lemmas = self.trigram_to_lemmas.get(t)
+				if lemmas is None:
+					return iter(())
+				candidates = set(lemmas) if candidates is None else candidates & lemmas
+				if not candidates:
+					return iter(())
+		else:
+			# Concept too short to use trigrams:
+			candidates = self.lemma_to_ids.keys()
+
+		lemmas = [lemma for lemma in candidates if concept in lemma]
+		if len(lemmas) == 1:
+			return iter(self.lemma_to_ids[lemmas[0]])
+		return heapq.merge(*[self.lemma_to_ids[lemma] for lemma in lemmas])
+
+	def _trigrams(self, s):
+		return {s[i:i+3] for i in range(len(s)-2)}
@@ -0,0 +1,133 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Version of the datasets built by train.py (change it when the way
+# they are built changes, so the cached ones are built again):
+DATASETS_VERSION = 2
+
+# Column of sequences of ints (e.g. the indices of the words of the questions)
+# stored as a single array of values plus offsets (values and offsets can be
+# memory-mapped arrays), behaves as a read-only list of 1-D arrays:
+class SequenceColumn:
+	def __init__(self, values, offsets):
+		self.values = values
+		self.offsets = offsets
+
+	@classmethod
+	def from_lists(cls, sequences, dtype=np.int32):
+		offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+		offsets[1:] = np.cumsum([len(s) for s in sequences])
+		values = np.fromiter((v for s in sequences for v in s), dtype=dtype, count=offsets[-1])
+		return cls(values, offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(len(self))
+			if step != 1:
+				raise ValueError("SequenceColumn slices don't support a step")
+			return SequenceColumn(self.values, self.offsets[start:max(stop, start)+1])
+		if i < 0:
+			i += len(self)
+		return self.values[self.offsets[i]:self.offsets[i+1]]
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	# Array of shape (len(self), maxlen) with the sequences padded and truncated
+	# at the beginning (as keras.preprocessing.sequence.pad_sequences):
+	def padded(self, maxlen=None, value=0):
+		lengths = self.lengths()
+		maxlen = maxlen if maxlen is not None else max(lengths.max(initial=0), 1)
+		padded = np.full((len(self), maxlen), value, dtype=self.values.dtype)
+		kept = np.minimum(lengths, maxlen)
+		rows = np.repeat(np.arange(len(self)), kept)
+		# Position of each kept value in its row and in self.values:
+		starts = np.cumsum(kept) - kept
+		positions = np.arange(kept.sum()) - np.repeat(starts, kept)
+		padded[rows, maxlen - np.repeat(kept, kept) + positions] = \
+			self.values[np.repeat(self.offsets[1:] - kept, kept) + positions]
+		return padded
+
+# Datasets built from the KB (sequences of indices, labels...) saved as .npy files
+# in directory and memory-mapped when loaded. A dataset is identified by its name
+# and by a key: the hash of the content of the files it is built from (KB, vocabularies)
+# and of the params used to build it, so it is built again if any of them changes:
+class DatasetCache:
+	def __init__(self, directory):
+		self.directory = Path(directory)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self._file_hashes = {}
+
+	def key(self, paths, **params):
+		h = hashlib.sha1()
+		for path in paths:
+			h.update(self._file_hash(path).encode())
+		h.update(json.dumps(dict(params, version=DATASETS_VERSION), sort_keys=True).encode())
+		return h.hexdigest()[:16]
+
+	# Return the arrays of the dataset (a dict name -> numpy array or SequenceColumn)
+	# or None if it's not in the cache:
+	def load(self, name, key):
+		index_path = self._path(name, key, "index.json")
+		if not index_path.is_file():
+			return None
+		with open(index_path) as index_file:
+			index = json.load(index_file)
+
+		dataset = {}
+		for array_name, kind in index.items():
+			load = lambda suffix: np.load(self._path(name, key, array_name + suffix), mmap_mode="r")
+			if kind == "sequences":
+				dataset[array_name] = SequenceColumn(load(".values.npy"), load(".offsets.npy"))
+			else:
+				dataset[array_name] = load(".npy")
+		return dataset
+
+	# Save the arrays of the dataset (lists of sequences are saved as SequenceColumns):
+	def save(self, name, key, **arrays):
+		index = {}
+		for array_name, array in arrays.items():
+			if isinstance(array, list) and array and not np.isscalar(array[0]):
+				array = SequenceColumn.from_lists(array)
+			if isinstance(array, SequenceColumn):
+				self._save_array(self._path(name, key, array_name + ".values.npy"), array.values)
+				self._save_array(self._path(name, key, array_name + ".offsets.npy"), array.offsets)
+				index[array_name] = "sequences"
+			else:
+				self._save_array(self._path(name, key, array_name + ".npy"), np.asarray(array))
+				index[array_name] = "array"
+
+		# The index is written last, the dataset is in the cache only if it's complete:
+		tmp_path = str(self._path(name, key, "index.json")) + ".tmp"
+		with open(tmp_path, "w") as index_file:
+			json.dump(index, index_file)
+		os.replace(tmp_path, self._path(name, key, "index.json"))
+
+	def _path(self, name, key, suffix):
+		return self.directory / (name + "_" + key + "." + suffix)
+
+	def _save_array(self, path, array):
+		tmp_path = str(path) + ".tmp.npy"
+		np.save(tmp_path, array)
+		os.replace(tmp_path, path)
+
+	def _file_hash(self, path):
+		path = str(path)
+		if path not in self._file_hashes:
+			h = hashlib.sha1()
+			with open(path, "rb") as f:
+				for chunk in iter(lambda: f.read(1 << 20), b""):
+					h.update(chunk)
+			self._file_hashes[path] = h.hexdigest()
+		return self._file_hashes[path]
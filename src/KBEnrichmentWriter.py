@@ -0,0 +1,182 @@
+from pathlib import Path
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+# Send the new elements of the KB (answers of the users) to the KB server in a
+# background thread, so the bot doesn't wait for the server. The elements are
+# sent in batches (up to batch_size elements, waiting at most batch_interval seconds
+# for them) over a persistent connection, a failed request is retried with exponential
+# backoff and, if the server is unreachable, the elements are appended to a spool
+# file (one JSON per line) and sent again after spool_retry_interval seconds (also
+# when the bot is restarted). An element can be sent twice if the bot is stopped
+# while sending the spool or if an error occurs (e.g. the disk is full), never lost:
+# the elements of a batch that fails are queued again and the malformed lines of
+# the spool are moved to spool_path + ".bad". The elements still queued are printed
+# only if the thread is stopped while the errors persist:
+class KBEnrichmentWriter:
+	def __init__(self, host, port, path, spool_path,
+				 batch_size=32, batch_interval=1.0, timeout=10,
+				 retries=3, backoff=1.0, spool_retry_interval=60):
+		self.host = host
+		self.port = port
+		self.path = path
+		self.spool_path = spool_path
+		self.replay_path = spool_path + ".replay"
+		self.bad_lines_path = spool_path + ".bad"
+		self.batch_size = batch_size
+		self.batch_interval = batch_interval
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.spool_retry_interval = spool_retry_interval
+
+		# Counters of the elements:
+		self.sent = 0
+		self.rejected = 0
+		self.spooled = 0
+
+		self._queue = queue.Queue()
+		self._conn = None
+		# Time before which the server is considered unreachable:
+		self._unreachable_until = 0
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	# Add an element to be sent to the server (returns immediately):
+	def add(self, item):
+		self._queue.put(item)
+
+	def stats(self):
+		return {
+			"sent": self.sent,
+			"rejected": self.rejected,
+			"spooled": self.spooled,
+			"queued": self._queue.qsize()
+		}
+
+	# Send the queued elements (spooling them if the server is unreachable) and stop the thread:
+	def close(self):
+		self._stop.set()
+		self._thread.join()
+		if self._conn is not None:
+			self._conn.close()
+			self._conn = None
+
+	def _run(self):
+		while not (self._stop.is_set() and self._queue.empty()):
+			batch = []
+			try:
+				batch = self._next_batch()
+				if batch:
+					self._send_batch(batch)
+				elif time.time() >= self._unreachable_until and not self._stop.is_set():
+					self._send_spool()
+			except Exception:
+				# An error must not stop the thread, the batch is sent again later
+				# (its elements already sent are sent twice):
+				traceback.print_exc()
+				for item in batch:
+					self._queue.put(item)
+				if self._stop.is_set():
+					self._print_lost()
+					return
+				self._stop.wait(self.spool_retry_interval)
+
+	# Wait for the first element (at most batch_interval seconds), then take the
+	# elements that arrive within batch_interval up to batch_size:
+	def _next_batch(self):
+		batch = []
+		deadline = time.time() + self.batch_interval
+		while len(batch) < self.batch_size:
+			try:
+				batch.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+			except queue.Empty:
+				break
+		return batch
+
+	def _send_batch(self, batch):
+		for i, item in enumerate(batch):
+			if time.time() < self._unreachable_until or not self._send(item):
+				self._spool(batch[i:])
+				return
+
+	# Send again the spooled elements (moved aside first, so the elements
+	# spooled again are not read twice):
+	def _send_spool(self):
+		if not Path(self.replay_path).is_file():
+			if not Path(self.spool_path).is_file():
+				return
+			os.replace(self.spool_path, self.replay_path)
+
+		items = []
+		with open(self.replay_path, encoding="utf-8") as replay_file:
+			for line in replay_file:
+				# (The last line is incomplete if the bot crashed while spooling)
+				if not line.endswith("\n"):
+					continue
+				try:
+					items.append(json.loads(line))
+				except ValueError:
+					print("Malformed line of the KB spool moved to " + self.bad_lines_path + ":", line.rstrip("\n"))
+					with open(self.bad_lines_path, "a", encoding="utf-8") as bad_lines_file:
+						bad_lines_file.write(line)
+		for i in range(0, len(items), self.batch_size):
+			self._send_batch(items[i:i+self.batch_size])
+		os.remove(self.replay_path)
+
+	# Send an element, returns False if the server is unreachable:
+	def _send(self, item):
+		body = json.dumps(item)
+		for attempt in range(self.retries + 1):
+			if attempt > 0:
+				time.sleep(self.backoff * 2 ** (attempt - 1))
+			try:
+				if self._conn is None:
+					self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+				self._conn.request("POST", self.path, body, {"Content-type": "application/json"})
+				response = self._conn.getresponse()
+				data = response.read()
+			except (OSError, http.client.HTTPException) as e:
+				print("KB server error:", e)
+				self._conn.close()
+				self._conn = None
+				continue
+
+			if response.getheader("Connection", "").lower() == "close":
+				self._conn.close()
+				self._conn = None
+			if response.status >= 500 or response.status == 429:
+				print("KB server error:", response.status, response.reason)
+				continue
+			# The server answers 1 if the element has been added, -1 otherwise:
+			if response.status == 200 and data.strip() != b"-1":
+				self.sent += 1
+			else:
+				print("Element rejected by the KB server:", response.status, data, item)
+				self.rejected += 1
+			return True
+
+		self._unreachable_until = time.time() + self.spool_retry_interval
+		return False
+
+	def _spool(self, items):
+		with open(self.spool_path, "a", encoding="utf-8") as spool_file:
+			for item in items:
+				spool_file.write(json.dumps(item) + "\n")
+			spool_file.flush()
+			os.fsync(spool_file.fileno())
+		self.spooled += len(items)
+
+	def _print_lost(self):
+		lost = []
+		while not self._queue.empty():
+			lost.append(self._queue.get_nowait())
+		print("KB elements not sent (" + str(len(lost)) + "):")
+		for item in lost:
+			print(json.dumps(item))
@@ -1,19 +1,155 @@
-import json
+import threading
+
+from CompactKnowledgeBase import CompactKnowledgeBase
+from ConceptIndex import ConceptIndex
+from KnowledgeBaseSnapshot import is_snapshot, load_snapshot
 
 class KnowledgeBase:
-	def __init__(self, kb_path):
+	def __init__(self, kb_path, babelNetCache=None):
 		# Open the Knowledge Base:
 		print("Loading the knowledge base...")
-		with open(kb_path) as kb_file:
-			self.kb = json.load(kb_file)
+
+		# Lemma columns (c1 lemmas, c2 lemmas) and index relation -> (c1 ConceptIndex,
+		# c2 ConceptIndex), built at load time if the cache is available, at first
+		# search otherwise (they are already in the file if it's a snapshot):
+		self.lemmas = None
+		self.malformed = None
+		self.index = None
+
+		# The index is updated while searching (see refresh) and
+		# the bot can search from many threads at the same time:
+		self._lock = threading.RLock()
+
+		if is_snapshot(kb_path):
+			self.kb, self.lemmas, self.malformed, self.index, self._load_unresolved, self._cache_version = load_snapshot(kb_path)
+			self._unresolved = None
+			print("Done.")
+		else:
+			self.kb = CompactKnowledgeBase(kb_path)
+			print("Done.")
+			if babelNetCache is not None:
+				self.build_index(babelNetCache)
+
+	# Resolve the concepts of every element once, lemmas[side][i] is the lemma of c1 (side 0)
+	# or c2 (side 1) of the i-th element (None if it can't be resolved), malformed[side][i]
+	# is True if the concept contains more than one babelNetID:
+	def resolve_concepts(self, babelNetCache):
+		self.lemmas = ([], [])
+		self.malformed = ([], [])
+		self._unresolved = {} # babelNetID -> list of (element index, side) not in cache
+		self._cache_version = babelNetCache.version
+
+		for elem_id, concepts in enumerate(zip(self.kb.iter_column("c1"), self.kb.iter_column("c2"))):
+			for side, concept in enumerate(concepts):
+				lemma = self._concept_to_word(babelNetCache, concept)
+				self.lemmas[side].append(lemma)
+				self.malformed[side].append(concept.count("bn:") >= 2)
+				if lemma is None and self._is_unresolved(concept):
+					babelNetID = concept[concept.index("bn:"):]
+					if babelNetID not in self._unresolved:
+						self._unresolved[babelNetID] = []
+					self._unresolved[babelNetID].append((elem_id, side))
+
+	# Build the index of the KB from the lemma columns:
+	def build_index(self, babelNetCache):
+		print("Indexing the knowledge base...")
+		self.resolve_concepts(babelNetCache)
+		self.index = {}
+
+		for elem_id, relation in enumerate(self.kb.iter_column("relation")):
+			if relation not in self.index:
+				self.index[relation] = (ConceptIndex(), ConceptIndex())
+			for side in (0, 1):
+				if self.lemmas[side][elem_id] is not None:
+					self.index[relation][side].add(self.lemmas[side][elem_id], elem_id)
 		print("Done.")
 
-	# Search for the element in the KB that best matches the given relation, c1 and c2:
+	# Resolve the concepts whose babelNetID has been added to the cache
+	# since the last call (builds the index the first time):
+	def refresh(self, babelNetCache):
+		with self._lock:
+			if self.index is None:
+				self.build_index(babelNetCache)
+				return
+			if babelNetCache.version == self._cache_version:
+				return
+
+			self._cache_version = babelNetCache.version
+			if self._unresolved is None:
+				self._unresolved = self._load_unresolved()
+			for babelNetID in [k for k in self._unresolved if k in babelNetCache.cache]:
+				for elem_id, side in self._unresolved.pop(babelNetID):
+					elem = self.kb[elem_id]
+					lemma = self._concept_to_word(babelNetCache, elem[("c1", "c2")[side]])
+					if lemma is not None:
+						self.lemmas[side][elem_id] = lemma
+						self.index[elem["relation"]][side].add(lemma, elem_id)
+
+	# Search for the element in the KB that best matches the given relation, c1 and c2
+	# (returns the first element that _search_linear would return):
 	def search(self, babelNetCache, relation, concept1=None, concept2=None):
 		if concept1: concept1 = concept1.lower()
 		if concept2: concept2 = concept2.lower()
 		print("Searching in the KB:")
 		print("\t" + relation + "\t" + str(concept1) + "\t" + str(concept2))
+
+		with self._lock:
+			self.refresh(babelNetCache)
+
+			if relation not in self.index:
+				return None
+			c1_index, c2_index = self.index[relation]
+			c1_lemmas, c2_lemmas = self.lemmas
+
+			elem_id = None
+			if concept1 != None and concept2 != None:
+				# Both concepts must match, unless one of the concepts
+				# of the element can't be resolved:
+				ids2 = set(c2_index.ids_containing(concept2))
+				for i in c1_index.ids_containing(concept1):
+					if c2_lemmas[i] is None or i in ids2:
+						elem_id = i
+						break
+				for i in c2_index.ids_containing(concept2):
+					if elem_id is not None and i >= elem_id:
+						break
+					if c1_lemmas[i] is None:
+						elem_id = i
+						break
+			elif concept1 != None:
+				elem_id = next(c1_index.ids_containing(concept1), None)
+			elif concept2 != None:
+				elem_id = next(c2_index.ids_containing(concept2), None)
+
+			return self.kb[elem_id] if elem_id is not None else None
+
+	# Search for the first element (of any relation) whose c1 lemma is concept1 and
+	# whose c2 lemma is concept2 (if both are specified) or whose c1 lemma is concept1
+	# or whose c2 lemma is concept2 (if only one is specified), malformed concepts
+	# never match:
+	def search_exact(self, babelNetCache, concept1=None, concept2=None):
+		with self._lock:
+			self.refresh(babelNetCache)
+
+			ids = [None, None]
+			for side, concept in enumerate((concept1, concept2)):
+				if concept is not None:
+					ids[side] = set()
+					for concept_indices in self.index.values():
+						ids[side].update(concept_indices[side].ids_for_lemma(concept))
+					ids[side] = {i for i in ids[side] if not self.malformed[side][i]}
+
+			if ids[0] is not None and ids[1] is not None:
+				candidates = ids[0] & ids[1]
+			else:
+				candidates = ids[0] if ids[0] is not None else ids[1]
+
+			return self.kb[min(candidates)] if candidates else None
+
+	# Linear version of search (scans the whole KB):
+	def _search_linear(self, babelNetCache, relation, concept1=None, concept2=None):
+		if concept1: concept1 = concept1.lower()
+		if concept2: concept2 = concept2.lower()
 		for elem in self.kb:
 			if elem["relation"] == relation:
 				c1_kb = self._concept_to_word(babelNetCache, elem["c1"])
@@ -29,6 +165,9 @@ class KnowledgeBase:
 						return elem
 		return None
 
+	# True if the concept is a babelNetID (case bnid) not yet in the cache:
+	def _is_unresolved(self, concept):
+		return concept.count("bn:") <= 2 and "::" not in concept and "bn:" in concept
 
 	# Transform the concept of the KB to the corresponding word:
 	def _concept_to_word(self, babelNetCache, concept):
@@ -0,0 +1,286 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from CompactKnowledgeBase import CompactKnowledgeBase, KBColumns, StringColumn, InternedColumn
+from ConceptIndex import ConceptIndex
+
+# Binary snapshot of the KB (elements, lemma columns and index) opened with mmap,
+# the pages are read from disk only when accessed and are shared by all the
+# processes mapping the same file. The format is:
+#     magic (8 bytes) | version (uint32) | header length (uint64) | JSON header | sections
+# where the header contains the metadata and the table of contents of the sections
+# (arrays aligned to 8 bytes, offsets relative to the first section):
+SNAPSHOT_MAGIC = b"KBSNAP\0\0"
+SNAPSHOT_VERSION = 1
+
+_HEADER_FORMAT = "<8sIQ"
+
+# True if the file at path is a KB snapshot:
+def is_snapshot(path):
+	with open(path, "rb") as f:
+		return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+# True if the snapshot at path has been compiled (with the current format) from the
+# current version of the KB at source_path, i.e. source_path has the same size and
+# modification time (the KB changes e.g. when it's downloaded again):
+def is_snapshot_of(path, source_path):
+	with open(path, "rb") as f:
+		magic, version, header_len = struct.unpack(_HEADER_FORMAT, f.read(struct.calcsize(_HEADER_FORMAT)))
+		if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+			return False
+		meta = json.loads(f.read(header_len).decode("utf-8"))["meta"]
+	return meta.get("source") == _source_stat(source_path)
+
+def _source_stat(path):
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+class SnapshotWriter:
+	def __init__(self):
+		self.sections = []
+		self.toc = {}
+		self.size = 0
+
+	# Add an array (or bytes) as a section:
+	def add(self, name, data):
+		typecode = data.typecode if isinstance(data, array) else "B"
+		itemsize = data.itemsize if isinstance(data, array) else 1
+		data = bytes(data) if not isinstance(data, array) else data.tobytes()
+		self.toc[name] = [self.size, len(data), typecode, itemsize]
+		padding = b"\0" * (-len(data) % 8)
+		self.sections.append(data + padding)
+		self.size += len(data) + len(padding)
+
+	def add_string_column(self, name, column):
+		self.add(name + ".data", column.data)
+		self.add(name + ".offsets", column.offsets)
+
+	def write(self, path, meta):
+		header = json.dumps({"meta": meta, "toc": self.toc}).encode("utf-8")
+		header += b" " * (-(struct.calcsize(_HEADER_FORMAT) + len(header)) % 8)
+		with open(path, "wb") as f:
+			f.write(struct.pack(_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+			f.write(header)
+			for section in self.sections:
+				f.write(section)
+
+class SnapshotReader:
+	def __init__(self, path):
+		self.file = open(path, "rb")
+		self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, version, header_len = struct.unpack_from(_HEADER_FORMAT, self.mmap)
+		if magic != SNAPSHOT_MAGIC:
+			raise ValueError(path + " is not a KB snapshot")
+		if version != SNAPSHOT_VERSION:
+			raise ValueError(path + " has version " + str(version) + ", expected " + str(SNAPSHOT_VERSION) +
+							 " (compile it again with compile_kb.py)")
+
+		base = struct.calcsize(_HEADER_FORMAT)
+		header = json.loads(self.mmap[base:base+header_len].decode("utf-8"))
+		self.meta = header["meta"]
+		self.toc = header["toc"]
+		self.base = base + header_len
+		self.view = memoryview(self.mmap)
+
+	# Return the section as a read-only memoryview (no data is copied):
+	def get(self, name):
+		offset, length, typecode, itemsize = self.toc[name]
+		if array(typecode).itemsize != itemsize:
+			raise ValueError("Snapshot created on a platform with different integer sizes")
+		view = self.view[self.base+offset:self.base+offset+length]
+		return view.cast(typecode) if typecode != "B" else view
+
+	def get_string_column(self, name):
+		return StringColumn(self.get(name + ".data"), self.get(name + ".offsets"))
+
+# Read-only ConceptIndex stored in the snapshot, lemmas and trigrams are sorted
+# (as UTF-8 bytes) and searched with binary search, the ids of the elements of
+# each lemma are stored contiguously. Elements added after the snapshot has been
+# created (see KnowledgeBase.refresh) are kept in a ConceptIndex in memory:
+class MappedConceptIndex:
+	def __init__(self, lemmas, ids_offsets, ids, trigrams, trigram_offsets, trigram_lemmas):
+		self.lemmas = lemmas
+		self.ids_offsets = ids_offsets
+		self.ids = ids
+		self.trigrams = trigrams
+		self.trigram_offsets = trigram_offsets
+		self.trigram_lemmas = trigram_lemmas
+		self.added = ConceptIndex()
+
+	def add(self, lemma, elem_id):
+		self.added.add(lemma, elem_id)
+
+	def ids_for_lemma(self, lemma):
+		i = self._find(self.lemmas, lemma)
+		ids = self.ids[self.ids_offsets[i]:self.ids_offsets[i+1]] if i != -1 else ()
+		added_ids = self.added.ids_for_lemma(lemma)
+		return list(heapq.merge(ids, added_ids)) if added_ids else ids
+
+	def ids_containing(self, concept):
+		if len(concept) >= 3:
+			candidates = None
+			for t in {concept[i:i+3] for i in range(len(concept)-2)}:
+				i = self._find(self.trigrams, t)
+				lemmas = set(self.trigram_lemmas[self.trigram_offsets[i]:self.trigram_offsets[i+1]]) if i != -1 else set()
+				candidates = lemmas if candidates is None else candidates & lemmas
+				if not candidates:
+					break
+		else:
+			# Concept too short to use trigrams:
+			candidates = range(len(self.lemmas))
+
+		lemma_ids = sorted([l for l in candidates if concept in self.lemmas[l]])
+		return heapq.merge(*([self.ids[self.ids_offsets[l]:self.ids_offsets[l+1]] for l in lemma_ids] +
+							 [self.added.ids_containing(concept)]))
+
+	# Binary search of s in a sorted StringColumn, returns its position or -1:
+	def _find(self, column, s):
+		key = s.encode("utf-8")
+		lo = 0
+		hi = len(column)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if bytes(column.data[column.offsets[mid]:column.offsets[mid+1]]) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < len(column) and bytes(column.data[column.offsets[lo]:column.offsets[lo+1]]) == key:
+			return lo
+		return -1
+
+# Lemma column of the snapshot (None where resolved[i] is 0),
+# lemmas resolved later are stored in memory:
+class MappedLemmaColumn:
+	def __init__(self, lemmas, resolved):
+		self.lemmas = lemmas
+		self.resolved = resolved
+		self.updated = {}
+
+	def __getitem__(self, i):
+		if i in self.updated:
+			return self.updated[i]
+		return self.lemmas[i] if self.resolved[i] else None
+
+	def __setitem__(self, i, lemma):
+		self.updated[i] = lemma
+
+	def __len__(self):
+		return len(self.resolved)
+
+# Write the snapshot of an indexed KnowledgeBase (loaded from source_path, whose
+# size and modification time are stored to check it with is_snapshot_of):
+def save_snapshot(knowledgeBase, path, source_path=None):
+	writer = SnapshotWriter()
+	columns = knowledgeBase.kb._columns
+	if len(knowledgeBase.kb) != columns.n:
+		raise ValueError("Can't save a snapshot of a slice of the KB")
+
+	# Elements:
+	columns_meta = {}
+	for key, column in columns.columns.items():
+		if isinstance(column, StringColumn):
+			writer.add_string_column("column." + key, column)
+			columns_meta[key] = "string"
+		else:
+			writer.add("column." + key + ".codes", column.codes)
+			columns_meta[key] = [v if isinstance(v, str) else list(v) for v in column.values]
+	writer.add("schema_codes", columns.schema_codes)
+	writer.add("others", json.dumps([[i, key, value] for (i, key), value in columns.others.items()]).encode("utf-8"))
+
+	# Lemma columns:
+	for side in (0, 1):
+		lemmas = StringColumn()
+		resolved = array("B")
+		for lemma in knowledgeBase.lemmas[side]:
+			lemmas.append(lemma if lemma is not None else "")
+			resolved.append(lemma is not None)
+		writer.add_string_column("lemmas." + str(side), lemmas)
+		writer.add("resolved." + str(side), resolved)
+		writer.add("malformed." + str(side), array("B", knowledgeBase.malformed[side]))
+	writer.add("unresolved", json.dumps(knowledgeBase._unresolved).encode("utf-8"))
+
+	# Index:
+	for relation, concept_indices in knowledgeBase.index.items():
+		for side, concept_index in enumerate(concept_indices):
+			name = "index." + relation + "." + str(side)
+			sorted_lemmas = sorted(concept_index.lemma_to_ids, key=lambda l: l.encode("utf-8"))
+			lemma_position = {lemma: i for i, lemma in enumerate(sorted_lemmas)}
+
+			lemmas = StringColumn()
+			ids_offsets = array("Q", [0])
+			ids = array("I")
+			for lemma in sorted_lemmas:
+				lemmas.append(lemma)
+				ids.extend(concept_index.lemma_to_ids[lemma])
+				ids_offsets.append(len(ids))
+
+			trigrams = StringColumn()
+			trigram_offsets = array("Q", [0])
+			trigram_lemmas = array("I")
+			for t in sorted(concept_index.trigram_to_lemmas, key=lambda t: t.encode("utf-8")):
+				trigrams.append(t)
+				trigram_lemmas.extend(sorted([lemma_position[l] for l in concept_index.trigram_to_lemmas[t]]))
+				trigram_offsets.append(len(trigram_lemmas))
+
+			writer.add_string_column(name + ".lemmas", lemmas)
+			writer.add(name + ".ids_offsets", ids_offsets)
+			writer.add(name + ".ids", ids)
+			writer.add_string_column(name + ".trigrams", trigrams)
+			writer.add(name + ".trigram_offsets", trigram_offsets)
+			writer.add(name + ".trigram_lemmas", trigram_lemmas)
+
+	writer.write(path, {
+		"n": columns.n,
+		"schemas": [list(schema) for schema in columns.schemas],
+		"columns": columns_meta,
+		"relations": list(knowledgeBase.index.keys()),
+		"cache_version": knowledgeBase._cache_version,
+		"source": _source_stat(source_path) if source_path is not None else None
+	})
+
+# Open a snapshot, returns (kb, lemmas, malformed, index, load_unresolved, cache_version)
+# as expected by KnowledgeBase, the concepts not resolved when the snapshot has been
+# created are read only when needed (calling load_unresolved) since it's slow:
+def load_snapshot(path):
+	reader = SnapshotReader(path)
+	meta = reader.meta
+
+	columns = KBColumns()
+	columns.n = meta["n"]
+	columns.schemas = [tuple(schema) for schema in meta["schemas"]]
+	columns.schema_to_code = {schema: code for code, schema in enumerate(columns.schemas)}
+	columns.schema_codes = reader.get("schema_codes")
+	for key, column_meta in meta["columns"].items():
+		if column_meta == "string":
+			columns.columns[key] = reader.get_string_column("column." + key)
+		else:
+			values = [v if isinstance(v, str) else tuple(v) for v in column_meta]
+			columns.columns[key] = InternedColumn(values, reader.get("column." + key + ".codes"))
+	columns.others = {(i, key): value for i, key, value in json.loads(bytes(reader.get("others")).decode("utf-8"))}
+	kb = CompactKnowledgeBase(columns=columns)
+
+	lemmas = tuple(MappedLemmaColumn(reader.get_string_column("lemmas." + str(side)), reader.get("resolved." + str(side)))
+				   for side in (0, 1))
+	malformed = tuple(reader.get("malformed." + str(side)) for side in (0, 1))
+	load_unresolved = lambda: {babelNetID: [tuple(entry) for entry in entries]
+							   for babelNetID, entries in json.loads(bytes(reader.get("unresolved")).decode("utf-8")).items()}
+
+	index = {}
+	for relation in meta["relations"]:
+		concept_indices = []
+		for side in (0, 1):
+			name = "index." + relation + "." + str(side)
+			concept_indices.append(MappedConceptIndex(reader.get_string_column(name + ".lemmas"),
+													  reader.get(name + ".ids_offsets"),
+													  reader.get(name + ".ids"),
+													  reader.get_string_column(name + ".trigrams"),
+													  reader.get(name + ".trigram_offsets"),
+													  reader.get(name + ".trigram_lemmas")))
+		index[relation] = tuple(concept_indices)
+
+	return kb, lemmas, malformed, index, load_unresolved, meta["cache_version"]
@@ -0,0 +1,75 @@
+import re
+
+# Match a question against the question patterns (e.g. "What color is X?"),
+# every pattern is compiled once into an anchored regex where X and Y
+# are slots capturing the concepts of the question:
+class PatternMatcher:
+	def __init__(self, question_patterns):
+		# First word of the pattern -> list of (regex, relation, specificity),
+		# patterns starting with a slot are stored with key None:
+		self.first_word_to_patterns = {}
+
+		for relation in question_patterns.relation_to_questions:
+			for q_p in question_patterns[relation]:
+				regex = self._compile(q_p)
+				if regex is None:
+					continue
+
+				first_word = self._first_word(q_p)
+				if "X" in first_word or "Y" in first_word:
+					first_word = None
+				else:
+					first_word = first_word.lower()
+				if first_word not in self.first_word_to_patterns:
+					self.first_word_to_patterns[first_word] = []
+
+				# Number of characters outside the slots:
+				specificity = len(q_p) - (q_p.find("X") != -1) - (q_p.find("Y") != -1)
+				self.first_word_to_patterns[first_word].append((regex, relation, specificity))
+
+		# Try the most specific patterns first:
+		for patterns in self.first_word_to_patterns.values():
+			patterns.sort(key=lambda p: -p[2])
+
+	# Return the list of (relation, conceptX, conceptY) of the patterns matching the
+	# question (conceptX or conceptY are None if the pattern has not the slot):
+	def match(self, question):
+		first_word = self._first_word(question).lower()
+		candidates = self.first_word_to_patterns.get(first_word, []) + self.first_word_to_patterns.get(None, [])
+		candidates.sort(key=lambda p: -p[2])
+
+		matches = []
+		for regex, relation, _ in candidates:
+			m = regex.match(question)
+			if m is None:
+				continue
+			slots = m.groupdict()
+			conceptX = slots["X"].strip().lower() if "X" in slots else None
+			conceptY = slots["Y"].strip().lower() if "Y" in slots else None
+			matches.append((relation, conceptX, conceptY))
+		return matches
+
+	# Compile the pattern into an anchored regex (None if there are no slots),
+	# whitespaces and final punctuation are not taken into account:
+	def _compile(self, q_p):
+		Xpos = q_p.find("X")
+		Ypos = q_p.find("Y")
+		if Xpos == -1 and Ypos == -1:
+			return None
+
+		slots = sorted([(pos, name) for pos, name in [(Xpos, "X"), (Ypos, "Y")] if pos != -1])
+		regex = r"^\s*"
+		prev = 0
+		for pos, name in slots:
+			regex += self._compile_text(q_p[prev:pos]) + r"(?P<" + name + r">.+?)"
+			prev = pos + 1
+		regex += self._compile_text(q_p[prev:].rstrip().rstrip("?.!")) + r"\s*[?.!]*\s*$"
+
+		return re.compile(regex, re.IGNORECASE)
+
+	def _compile_text(self, text):
+		return r"\s+".join([re.escape(w) for w in re.split(r"\s+", text)])
+
+	def _first_word(self, sentence):
+		words = sentence.split()
+		return words[0] if len(words) > 0 else ""
@@ -48,7 +48,7 @@ class QuestionGenerator:
 			id2 = random.choice(self.domain_to_concepts[domain])
 			question_data["id2"] = id2
 			
-			w2 = babelNetIdToLemma(id2)
+			w2 = utils.babelNetIdToLemma(id2, babelNetCache)
 			question_data["c2"] = w2
 			
 			question = question.replace("X", w1)
@@ -37,10 +37,4 @@ class Vocabulary:
 
 	# Return a list of indices given a sentence:
 	def sentence2indices(self, sentence):
-		q = []
-		for w in utils.split_words_punctuation(sentence):
-			if w in self.word2index:
-				q.append(self.word2index[w])
-			else:
-				q.append(0)
-		return q
+		return [self.word2index.get(w, 0) for w in utils.tokenize(sentence).tokens]
@@ -0,0 +1,372 @@
+# Benchmarks of the parts of the bot that are executed for every message,
+# run the benchmark by typing (e.g.):
+#     python3 benchmark.py search
+
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from BabelNetCache import BabelNetCache
+from BabelNetClient import BackgroundLoop
+from BatchPredictor import BatchPredictor
+from ChatDispatcher import ChatDispatcher
+from CompactKnowledgeBase import CompactKnowledgeBase
+from KnowledgeBase import KnowledgeBase
+from QuestionPatterns import QuestionPatterns
+import utils
+
+KB_PATH = "../resources/kb.json"
+BABELNET_CACHE_PATH = "../resources/babelnet_cache.tsv"
+PATTERNS_PATH = "../resources/patterns.tsv"
+DOMAIN_LIST_PATH = "../babelnet/BabelDomains_full/domain_list.txt"
+
+# Return the average time (in ms) of a call of f over the list of arguments,
+# the prints of f are suppressed:
+def time_calls(f, args_list):
+	with contextlib.redirect_stdout(io.StringIO()):
+		start = time.perf_counter()
+		results = [f(*args) for args in args_list]
+		elapsed = time.perf_counter() - start
+	return elapsed / max(len(args_list), 1) * 1000, results
+
+# Compare the linear scan of the KB with the indexed search
+# using the concepts of random elements of the KB as queries:
+def benchmark_search(n_queries=100):
+	babelNetCache = BabelNetCache(BABELNET_CACHE_PATH)
+	knowledgeBase = KnowledgeBase(KB_PATH)
+
+	start = time.perf_counter()
+	knowledgeBase.build_index(babelNetCache)
+	print("Index built in %.2fs" % (time.perf_counter() - start))
+
+	queries = []
+	for elem_id in random.sample(range(len(knowledgeBase.kb)), min(n_queries, len(knowledgeBase.kb))):
+		relation = knowledgeBase.kb[elem_id]["relation"]
+		c1, c2 = knowledgeBase.lemmas[0][elem_id], knowledgeBase.lemmas[1][elem_id]
+		# Same combinations of concepts used by bot.py:
+		queries.append((babelNetCache, relation, c1, c2))
+		queries.append((babelNetCache, relation, c1, None))
+		queries.append((babelNetCache, relation, None, c2))
+
+	linear_ms, linear_results = time_calls(knowledgeBase._search_linear, queries)
+	index_ms, index_results = time_calls(knowledgeBase.search, queries)
+
+	mismatches = sum([1 for a, b in zip(linear_results, index_results) if a != b])
+	print("Queries: " + str(len(queries)) + " | Mismatches: " + str(mismatches))
+	print("Linear search: %.3f ms/query" % linear_ms)
+	print("Indexed search: %.3f ms/query" % index_ms)
+	print("Speedup: %.1fx" % (linear_ms / max(index_ms, 1e-9)))
+
+# Compare utils.levenshtein with utils.levenshtein_many on the question
+# patterns (answer generator) and on the BabelNet domains (domain recognition):
+def benchmark_levenshtein(n_queries=20):
+	questionPatterns = QuestionPatterns(PATTERNS_PATH)
+	patterns = [q_p for r in questionPatterns.relation_to_questions for q_p in questionPatterns[r]]
+	with open(DOMAIN_LIST_PATH) as domain_list_file:
+		domains = [line.rstrip().lower() for line in domain_list_file]
+
+	# Questions are patterns filled with a concept, domains are misspelled:
+	questions = [random.choice(patterns).replace("X", "the kitchen table").replace("Y", "furniture") for _ in range(n_queries)]
+	misspelled_domains = [d[:len(d)//2] + d[len(d)//2+1:] for d in random.sample(domains, min(n_queries, len(domains)))]
+
+	for name, queries, candidates in [("Patterns", questions, patterns), ("Domains", misspelled_domains, domains)]:
+		start = time.perf_counter()
+		one_by_one = [[utils.levenshtein(q, c) for c in candidates] for q in queries]
+		one_by_one_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+		start = time.perf_counter()
+		many = [list(utils.levenshtein_many(q, candidates)) for q in queries]
+		many_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+		print(name + " (" + str(len(candidates)) + " candidates) | Equal results: " + str(one_by_one == many))
+		print("\tlevenshtein: %.3f ms/query" % one_by_one_ms)
+		print("\tlevenshtein_many: %.3f ms/query" % many_ms)
+		print("\tSpeedup: %.1fx" % (one_by_one_ms / max(many_ms, 1e-9)))
+
+# Current RSS of the process in MB (Linux only):
+def current_rss_mb():
+	with open("/proc/self/statm") as statm:
+		return int(statm.read().split()[1]) * resource.getpagesize() / 2**20
+
+def _load_kb(loader, queue):
+	rss_before = current_rss_mb()
+	start = time.perf_counter()
+	if loader == "json":
+		with open(KB_PATH) as kb_file:
+			kb = json.load(kb_file)
+	else:
+		kb = CompactKnowledgeBase(KB_PATH)
+	elapsed = time.perf_counter() - start
+	gc.collect()
+	# ru_maxrss is in KB on Linux:
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+	queue.put((len(kb), elapsed, peak_rss - rss_before, current_rss_mb() - rss_before))
+
+# Compare peak and steady-state memory of json.load with the streaming
+# columnar loader, each loader runs in a new process:
+def benchmark_kb_memory():
+	for loader in ["json", "compact"]:
+		queue = multiprocessing.Queue()
+		process = multiprocessing.Process(target=_load_kb, args=(loader, queue))
+		process.start()
+		n, elapsed, peak_rss, steady_rss = queue.get()
+		process.join()
+		print(loader + " loader (" + str(n) + " elements) | Time: %.2fs | Peak RSS: +%.1f MB | Steady RSS: +%.1f MB" %
+			  (elapsed, peak_rss, steady_rss))
+
+# Compare the startup time of the KB from JSON (load and index) and from a snapshot:
+def benchmark_kb_startup(snapshot_path="../resources/kb.snapshot"):
+	babelNetCache = BabelNetCache(BABELNET_CACHE_PATH)
+	for path in [KB_PATH, snapshot_path]:
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			knowledgeBase = KnowledgeBase(path, babelNetCache)
+			elapsed = time.perf_counter() - start
+			first_search_start = time.perf_counter()
+			knowledgeBase.search(babelNetCache, "COLOR", "apple")
+			first_search = time.perf_counter() - first_search_start
+		print(path + " | Startup: %.3fs | First search: %.3fs" % (elapsed, first_search))
+
+# Compare the serial loop of telepot (one message at a time) with ChatDispatcher
+# (--asyncio mode of the bot) sending n_messages from n_chats at the given rate
+# (messages/s), handling a message waits io_ms (queries to Babelfy, Telegram...)
+# and computes for cpu_ms (NN inference, KB search):
+def benchmark_serving(n_chats=20, n_messages=200, rate=50, io_ms=100, cpu_ms=5, workers=8):
+	for mode in ["serial", "asyncio"]:
+		msgs = [{"chat": {"id": i % n_chats}, "seq": i} for i in range(n_messages)]
+		handled = []
+		all_handled = threading.Event()
+
+		def handler(msg):
+			time.sleep(io_ms / 1000)
+			end = time.perf_counter() + cpu_ms / 1000
+			while time.perf_counter() < end:
+				pass
+			msg["handled"] = time.perf_counter()
+			handled.append(msg)
+			if len(handled) == n_messages:
+				all_handled.set()
+
+		if mode == "serial":
+			pending = queue.Queue()
+			def serial_loop():
+				while True:
+					handler(pending.get())
+			threading.Thread(target=serial_loop, daemon=True).start()
+			submit = pending.put
+		else:
+			submit = ChatDispatcher(handler, BackgroundLoop().loop, workers).submit
+
+		for msg in msgs:
+			msg["sent"] = time.perf_counter()
+			submit(msg)
+			time.sleep(1 / rate)
+		all_handled.wait()
+
+		latencies = sorted([(msg["handled"] - msg["sent"]) * 1000 for msg in msgs])
+		elapsed = max([msg["handled"] for msg in msgs]) - msgs[0]["sent"]
+		# The messages of every chat must be handled in the order they have been sent:
+		ordered = all([[msg["seq"] for msg in handled if msg["chat"]["id"] == chat_id] ==
+					   [msg["seq"] for msg in msgs if msg["chat"]["id"] == chat_id] for chat_id in range(n_chats)])
+		print(mode + " | Throughput: %.1f msg/s | Latency: mean %.0f ms, p95 %.0f ms, max %.0f ms | Ordered: %s" %
+			  (n_messages / elapsed, sum(latencies) / n_messages, latencies[int(n_messages * 0.95) - 1], latencies[-1], ordered))
+
+# Compare model.predict (one request at a time, as the bot without batching) with
+# BatchPredictor, n_requests random answers (as bot.py does) are predicted by
+# n_threads threads:
+def benchmark_inference(n_requests=400, n_threads=16, max_batch_size=64, max_wait=0.005,
+						model_path="../models/concept_extractor_answer.keras"):
+	# (Imported here, the other benchmarks don't need them)
+	import keras
+	import tensorflow as tf
+
+	model = keras.models.load_model(model_path)
+	graph = tf.get_default_graph()
+	vocabulary_dim = model.layers[0].input_dim
+	requests = [np.random.randint(1, vocabulary_dim, size=random.randint(3, 15)) for _ in range(n_requests)]
+
+	lock = threading.Lock()
+	def predict(x):
+		with lock, graph.as_default():
+			return model.predict(x)
+	batchPredictor = BatchPredictor(model, graph, max_batch_size, max_wait)
+
+	results = {}
+	for name, f in [("predict", predict), ("BatchPredictor", batchPredictor.predict)]:
+		with ThreadPoolExecutor(n_threads) as executor:
+			start = time.perf_counter()
+			results[name] = list(executor.map(f, requests))
+			elapsed = time.perf_counter() - start
+		print(name + " | Throughput: %.1f requests/s" % (n_requests / elapsed))
+
+	equal = all([np.allclose(a, b, atol=1e-5) for a, b in zip(results["predict"], results["BatchPredictor"])])
+	print("Equal results: " + str(equal) + " | Mean batch: %.1f requests" % batchPredictor.stats()["mean_batch_requests"])
+
+# Number and size (in MB) of the memory allocations on CPU made by f:
+def count_allocations(f):
+	from torch.profiler import profile, ProfilerActivity
+	with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+		f()
+	allocations = [e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0]
+	return len(allocations), sum(allocations) / 2**20
+
+# Compare the per-token latency and allocations of the answers of Seq2Seq with the
+# eval forward used by the bot before (one question at a time, log-softmax outputs),
+# with Seq2Seq.decode and with Seq2SeqInference (one question at a time and in batches
+# of batch_size), the model has random weights (the decoding always takes target_length
+# steps, unless EOS is predicted):
+def benchmark_seq2seq_inference(n_questions=64, batch_size=32, target_length=30,
+								input_vocabulary_dim=20000, target_vocabulary_dim=5000, hidden_size=256):
+	import torch
+	from seq2seq.Seq2Seq import Seq2Seq
+	from seq2seq.Seq2SeqInference import Seq2SeqInference
+
+	model = Seq2Seq("eval", input_vocabulary_dim, target_vocabulary_dim, 0, 1, 2, hidden_size, hidden_size, 300,
+					embedding_padding_idx=0)
+	questions = torch.randint(3, input_vocabulary_dim, (n_questions, 10))
+	inference = Seq2SeqInference(model, batch_size, target_length)
+
+	# The padding at the beginning of a question must not change its encoding, the
+	# unknown words inside it (with the same index as the padding) must be kept:
+	question = torch.LongTensor([[3, 7, 0, 9, 11]])
+	padded = torch.cat([torch.zeros(1, 3, dtype=torch.long), question], 1)
+	with torch.no_grad():
+		hidden = model.encoder_gru(model.encoder_embedding(question))[1]
+		assert torch.allclose(model._encoder_forward(padded)[1], hidden, atol=1e-6)
+
+	def forward(x):
+		ids = []
+		for y_p in model(x, torch.LongTensor([[model.GO_SYMBOL_IDX]] * x.size()[0]), target_length):
+			topv, topi = y_p.data.topk(1)
+			ids.append(topi)
+		return torch.cat(ids, 1)
+
+	def decode(x):
+		with torch.no_grad():
+			return model.decode(x, target_length)
+
+	for name, f, size in [("forward", forward, 1),
+						  ("decode", decode, 1),
+						  ("Seq2SeqInference", inference.decode, 1),
+						  ("decode", decode, batch_size),
+						  ("Seq2SeqInference", inference.decode, batch_size)]:
+		batches = [questions[i:i+size] for i in range(0, n_questions, size)]
+		f(batches[0]) # warm up
+		start = time.perf_counter()
+		n_tokens = sum([f(x).numel() for x in batches])
+		elapsed = time.perf_counter() - start
+		n_allocations, allocated_mb = count_allocations(lambda: f(batches[0]))
+		tokens = f(batches[0]).numel()
+		print(name + " (batch " + str(size) + ") | Latency: %.3f ms/token | Allocations: %.1f/token (%.3f MB/token)" %
+			  (elapsed / n_tokens * 1000, n_allocations / tokens, allocated_mb / tokens))
+
+# Compare the per-token latency of Seq2SeqInference scoring the whole target vocabulary
+# with scoring a shortlist of shortlist_size words plus the words of the questions,
+# the model has random weights so the fallback is disabled (its answers are not
+# meaningful, the percentage of tokens equal to the full decoding is reported anyway):
+def benchmark_shortlist(n_questions=64, batch_size=32, shortlist_size=1000,
+						input_vocabulary_dim=20000, target_vocabulary_dim=50000, hidden_size=256):
+	import torch
+	from seq2seq.Seq2Seq import Seq2Seq
+	from seq2seq.Seq2SeqInference import Seq2SeqInference
+	from seq2seq.Shortlist import Shortlist
+
+	# Vocabularies sharing the words with the same index:
+	class RandomVocabulary:
+		def __init__(self, dim):
+			self.VOCABULARY_DIM = dim
+			self.word2index = {"w" + str(i): i for i in range(dim)}
+			self.PAD_SYMBOL = "w0"
+
+	model = Seq2Seq("eval", input_vocabulary_dim, target_vocabulary_dim, 0, 1, 2, hidden_size, hidden_size, 300,
+					embedding_padding_idx=0)
+	questions = torch.randint(3, input_vocabulary_dim, (n_questions, 10))
+	shortlist = Shortlist(random.sample(range(3, target_vocabulary_dim), shortlist_size),
+						  RandomVocabulary(input_vocabulary_dim), RandomVocabulary(target_vocabulary_dim),
+						  [model.EOS_SYMBOL_IDX], fallback_probability=0)
+
+	results = {}
+	for name, inference in [("Full vocabulary", Seq2SeqInference(model, batch_size)),
+							("Shortlist", Seq2SeqInference(model, batch_size, shortlist=shortlist))]:
+		batches = [questions[i:i+batch_size] for i in range(0, n_questions, batch_size)]
+		inference.decode(batches[0]) # warm up
+		start = time.perf_counter()
+		results[name] = [inference.decode(x) for x in batches]
+		elapsed = time.perf_counter() - start
+		n_tokens = sum([ids.numel() for ids in results[name]])
+		print(name + " | Latency: %.3f ms/token" % (elapsed / n_tokens * 1000))
+
+	same = sum([(a == b).sum().item() for a, b in zip(results["Full vocabulary"], results["Shortlist"]) if a.shape == b.shape])
+	print("Tokens equal to the full decoding: %.1f%%" % (same / sum([ids.numel() for ids in results["Full vocabulary"]]) * 100))
+
+# Throughput of the training iterations of Seq2Seq (seq2seq.utils._compute_loss,
+# backward and step of the optimizer) on random batches of answers with padding,
+# with the decoder fed with its own predictions and teacher forced:
+def benchmark_seq2seq_training(n_iterations=20, batch_size=32, target_length=30,
+							   input_vocabulary_dim=20000, target_vocabulary_dim=5000, hidden_size=256):
+	import torch
+	from seq2seq.Seq2Seq import Seq2Seq
+	import seq2seq.utils
+
+	model = Seq2Seq("train", input_vocabulary_dim, target_vocabulary_dim, 0, 1, 2, hidden_size, hidden_size, 300,
+					embedding_padding_idx=0)
+	model = model.cuda() if torch.cuda.is_available() else model
+	optimizer = torch.optim.Adam(model.parameters())
+	criterion = torch.nn.NLLLoss(ignore_index=0)
+	device = next(model.parameters()).device
+
+	# Answers of random length (padded at the end):
+	batches = []
+	for _ in range(n_iterations + 1):
+		x = torch.randint(3, input_vocabulary_dim, (batch_size, 10), device=device)
+		y = torch.randint(3, target_vocabulary_dim, (batch_size, target_length), device=device)
+		lengths = torch.randint(1, target_length + 1, (batch_size, 1), device=device)
+		y.masked_fill_(torch.arange(target_length, device=device) >= lengths, 0)
+		batches.append((x, y))
+
+	def iteration(x, y, teacher_forcing):
+		optimizer.zero_grad()
+		loss, correct_predicted_words_cnt, words_cnt = seq2seq.utils._compute_loss(model, criterion, x, y, teacher_forcing)
+		loss.backward()
+		optimizer.step()
+
+	for name, teacher_forcing in [("Free running", False), ("Teacher forcing", True)]:
+		iteration(*batches[0], teacher_forcing) # warm up
+		start = time.perf_counter()
+		for x, y in batches[1:]:
+			iteration(x, y, teacher_forcing)
+		elapsed = time.perf_counter() - start
+		print(name + " | %.2f iterations/s | %.1f sentences/s | %.1f ms/iteration" %
+			  (n_iterations / elapsed, n_iterations * batch_size / elapsed, elapsed / n_iterations * 1000))
+
+BENCHMARKS = {
+	"search": benchmark_search,
+	"levenshtein": benchmark_levenshtein,
+	"kb_memory": benchmark_kb_memory,
+	"kb_startup": benchmark_kb_startup,
+	"serving": benchmark_serving,
+	"inference": benchmark_inference,
+	"seq2seq_inference": benchmark_seq2seq_inference,
+	"shortlist": benchmark_shortlist,
+	"seq2seq_training": benchmark_seq2seq_training
+}
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+		print("You need to specify a benchmark.")
+		print("Select one between:")
+		for name in BENCHMARKS:
+			print(" * " + name)
+		sys.exit(-1)
+	BENCHMARKS[sys.argv[1]](*[int(arg) if arg.isdigit() else arg for arg in sys.argv[2:]])
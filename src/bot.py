@@ -1,5 +1,6 @@
 from enum import Enum
 
+import atexit
 import http.client
 import json
 
@@ -12,6 +13,8 @@ from telepot.loop import MessageLoop
 
 import time
 
+from pathlib import Path
+
 import keras
 import tensorflow as tf
 import torch
@@ -21,13 +24,21 @@ import re
 
 from AnswerGenerator import AnswerGenerator
 from BabelNetCache import BabelNetCache
+from BabelfyCache import BabelfyCache
+from BabelNetClient import BabelNetClient, BackgroundLoop
+from BatchPredictor import BatchPredictor
+from ChatDispatcher import ChatDispatcher
+from KBEnrichmentWriter import KBEnrichmentWriter
 from KnowledgeBase import KnowledgeBase
+from KnowledgeBaseSnapshot import is_snapshot_of
 from QuestionGenerator import QuestionGenerator
 from QuestionPatterns import QuestionPatterns
 from utils import *
 from Word2Vec import *
 
 from seq2seq.Seq2Seq import Seq2Seq
+from seq2seq.Seq2SeqInference import Seq2SeqInference
+from seq2seq.Shortlist import Shortlist, load_shortlist
 import seq2seq.utils
 
 import sys
@@ -39,9 +50,35 @@ SERVER_IP_ADDRESS = "151.100.179.26"
 SERVER_PORT = 8080
 SERVER_PATH = "/KnowledgeBaseServer/rest-api/"
 
+# Max. number of patterns (and their max. Levenshtein distance from the
+# question) tried by the answer generator for each question (None for all):
+ANSWER_GENERATOR_TOP_K = 10
+ANSWER_GENERATOR_MAX_DISTANCE = None
+
+# Max. number of elements of the BabelNet cache (None for unbounded) and
+# seconds before querying again a babelNetID that BabelNet can't resolve:
+BABELNET_CACHE_MAX_SIZE = None
+BABELNET_CACHE_NEGATIVE_TTL = 3600
+BABELFY_CACHE_MAX_SIZE = 100000
+
+# Number of threads handling the messages in asyncio mode (--asyncio):
+BOT_WORKERS = 8
+
+# Max. number of samples predicted together by the NN models and max. seconds
+# waiting for other requests (only in asyncio mode, the requests are serial otherwise):
+INFERENCE_MAX_BATCH_SIZE = 64
+INFERENCE_MAX_WAIT = 0.005
+
+# Shortlist of the words scored by Seq2Seq (created by train.py) and min. probability
+# of the best word of the shortlist (the whole vocabulary is scored otherwise):
+SEQ2SEQ_SHORTLIST_PATH = "../models/seq2seq_shortlist.json"
+SEQ2SEQ_SHORTLIST_FALLBACK_PROBABILITY = 0.1
+
 USE_SEQ2SEQ = False
 USE_ANSWER_GENERATOR = False
 USE_CONCEPT_EXTRACTOR = False
+USE_ASYNCIO = False
+USE_QUANTIZATION = False
 
 # User status (for each user the bot has a different behaviour):
 class USER_STATUS(Enum):
@@ -67,8 +104,28 @@ question_generator = QuestionGenerator("../babelnet/BabelDomains_full/BabelDomai
 									   "../resources/domains_to_relations.tsv",
 									   questionPatterns)
 
-# BabelNetCache:
-babelNetCache = BabelNetCache("../resources/babelnet_cache.tsv")
+# BabelNetCache (the new elements found from the queries are
+# saved in the log of the cache while the bot is running):
+babelNetCache = BabelNetCache("../resources/babelnet_cache.tsv", persistent=True,
+							  max_size=BABELNET_CACHE_MAX_SIZE, negative_ttl=BABELNET_CACHE_NEGATIVE_TTL)
+atexit.register(babelNetCache.close)
+
+# BabelfyCache (results of Babelfy for the answers of the users, many answers
+# are repeated, e.g. "red", "in the kitchen"):
+babelfyCache = BabelfyCache("../resources/babelfy_cache.tsv", persistent=True, max_size=BABELFY_CACHE_MAX_SIZE)
+atexit.register(babelfyCache.close)
+
+# New elements of the KB sent to the server in background (spooled
+# to disk while the server is unreachable):
+kbEnrichmentWriter = KBEnrichmentWriter(SERVER_IP_ADDRESS, SERVER_PORT,
+										SERVER_PATH + "add_item_test?key=" + BABELNET_KEY,
+										"../resources/kb_enrichment_spool.jsonl")
+atexit.register(kbEnrichmentWriter.close)
+
+# Client of BabelNet/Babelfy (the connections are kept alive and reused),
+# its coroutines run in a background event loop:
+babelNetClient = BabelNetClient(babelNetCache, babelfyCache)
+babelNetLoop = BackgroundLoop()
 
 # HParams from json file (command line args):
 with open(sys.argv[1]) as hparams_file:
@@ -106,6 +163,16 @@ else:
 	print(" * --onlyanswer")
 	print(" * --bothQA")
 
+# Options (optional):
+#  * --asyncio: handle the messages of different chats concurrently;
+#  * --quantize: use Seq2Seq with GRU and Linear layers quantized to int8 (CPU only).
+if "--asyncio" in sys.argv[4:]:
+	print("Bot is handling the chats concurrently.")
+	USE_ASYNCIO = True
+if "--quantize" in sys.argv[4:]:
+	print("Bot is using Seq2Seq quantized to int8.")
+	USE_QUANTIZATION = True
+
 # HParams for answer generator:
 hparams_answer_generator = hparams["answerGenerator"]
 hparams_relation_classifier = hparams["relationClassifier"]
@@ -126,6 +193,12 @@ concept_extractor_question = keras.models.load_model("../models/concept_extracto
 concept_extractor_answer = keras.models.load_model("../models/concept_extractor_answer.keras")
 graph = tf.get_default_graph()
 
+# The predictions of the concurrent requests are done in batches:
+inference_max_wait = INFERENCE_MAX_WAIT if USE_ASYNCIO else 0
+relation_classifier_predictor = BatchPredictor(relation_classifier, graph, INFERENCE_MAX_BATCH_SIZE, inference_max_wait)
+concept_extractor_question_predictor = BatchPredictor(concept_extractor_question, graph, INFERENCE_MAX_BATCH_SIZE, inference_max_wait)
+concept_extractor_answer_predictor = BatchPredictor(concept_extractor_answer, graph, INFERENCE_MAX_BATCH_SIZE, inference_max_wait)
+
 if USE_SEQ2SEQ:
 	seq2seq_model = Seq2Seq("eval",
 							vocabulary_encoder.VOCABULARY_DIM, vocabulary_decoder.VOCABULARY_DIM,
@@ -144,15 +217,36 @@ if USE_SEQ2SEQ:
 		if not k.endswith("l1"):
 			new_state_dict[k] = v
 	seq2seq_model.load_state_dict(new_state_dict)
-	seq2seq_model = seq2seq_model.cuda() if torch.cuda.is_available() else seq2seq_model
+	if USE_QUANTIZATION:
+		# (Seq2SeqInference works only with the float weights)
+		seq2seq_model = seq2seq.utils.quantize(seq2seq_model)
+		seq2seq_inference = seq2seq_model
+	else:
+		seq2seq_model = seq2seq_model.cuda() if torch.cuda.is_available() else seq2seq_model
+		shortlist = None
+		if Path(SEQ2SEQ_SHORTLIST_PATH).is_file():
+			shortlist = Shortlist(load_shortlist(SEQ2SEQ_SHORTLIST_PATH), vocabulary_encoder, vocabulary_decoder,
+								  [seq2seq_model.EOS_SYMBOL_IDX], SEQ2SEQ_SHORTLIST_FALLBACK_PROBABILITY)
+		seq2seq_inference = Seq2SeqInference(seq2seq_model, INFERENCE_MAX_BATCH_SIZE, 30, shortlist)
+	# Questions padded at the beginning (they are reversed):
+	seq2seq_predictor = BatchPredictor(seq2seq_inference, None, INFERENCE_MAX_BATCH_SIZE, inference_max_wait, padding="pre")
 
 print("Done.")
 
-# Open the Knowledge Base:
-knowledgeBase = KnowledgeBase("../resources/kb.json")
+# Open the Knowledge Base (and index it using the cache), the snapshot
+# created by compile_kb.py is used if available and compiled from the
+# current kb.json (or if there's no kb.json):
+kb_path = "../resources/kb.json"
+if Path("../resources/kb.snapshot").is_file():
+	if not Path(kb_path).is_file() or is_snapshot_of("../resources/kb.snapshot", kb_path):
+		kb_path = "../resources/kb.snapshot"
+	else:
+		print("Warning: ../resources/kb.snapshot is out of date (compile it again with compile_kb.py), using " + kb_path)
+knowledgeBase = KnowledgeBase(kb_path, babelNetCache)
 
 # Answer generator:
-answerGenerator = AnswerGenerator(knowledgeBase, questionPatterns)
+answerGenerator = AnswerGenerator(knowledgeBase, questionPatterns,
+								  ANSWER_GENERATOR_TOP_K, ANSWER_GENERATOR_MAX_DISTANCE)
 
 # Dictionary of user status (manage multiple users):
 user_status = {}
@@ -201,6 +295,7 @@ def handle(msg):
 					except:
 						pass
 
+				print("BabelNet cache:", babelNetCache.stats())
 				user_status[chat_id].question_data = question_data
 				user_status[chat_id].question = question_data["question"]
 				user_status[chat_id].relation = question_data["relation"]
@@ -211,31 +306,26 @@ def handle(msg):
 			if USE_SEQ2SEQ:
 				q_qaNN = vocabulary_encoder.sentence2indices(user_status[chat_id].question)
 				q_qaNN.reverse() # Q&A NN uses reversed sentence
-				encoder_input = torch.autograd.Variable(torch.LongTensor([q_qaNN]))
-				decoder_input = torch.autograd.Variable(torch.LongTensor([[seq2seq_model.GO_SYMBOL_IDX]]))
-				if torch.cuda.is_available():
-					encoder_input = encoder_input.cuda()
-					decoder_input = decoder_input.cuda()
-				answer_idx = []
-				answer_softmax = seq2seq_model(encoder_input, decoder_input, 30)
-				for answer_softmax_i in answer_softmax:
-					topv, topi = answer_softmax_i.data.topk(1)
-					answer_idx.append(topi[0][0])
-				answer = " ".join([vocabulary_decoder.index2word[w_idx] for w_idx in answer_idx[:-1]])
+				# Decoded together with the questions of the other chats:
+				answer_idx = seq2seq_predictor.predict(np.array([q_qaNN]))[0].tolist()
+				if seq2seq_model.EOS_SYMBOL_IDX in answer_idx:
+					answer_idx = answer_idx[:answer_idx.index(seq2seq_model.EOS_SYMBOL_IDX)]
+				answer = " ".join([vocabulary_decoder.index2word[w_idx] for w_idx in answer_idx])
 				if answer == "":
 					answer = "I don't understand." # NN could return an empty sequence
 			elif USE_ANSWER_GENERATOR:
 				answer = answerGenerator.generate(msg["text"], babelNetCache)
+				print("Answer ranks:", answerGenerator.answer_rank_counts)
 			else: # USE_CONCEPT_EXTRACTOR
 				q_rcNN = relation_classifier_vocabulary.sentence2indices(user_status[chat_id].question)
-				with graph.as_default():
-					relation = int_to_relation(np.argmax(relation_classifier.predict(np.array(q_rcNN))[0]))
-					probability_concept = concept_extractor_question.predict(np.array(concept_extractor_question_vocabulary.sentence2indices(user_status[chat_id].question)))
+				relation = int_to_relation(np.argmax(relation_classifier_predictor.predict(np.array(q_rcNN))[0]))
+				probability_concept = concept_extractor_question_predictor.predict(np.array(concept_extractor_question_vocabulary.sentence2indices(user_status[chat_id].question)))
 				
 				#print(probability_concept)
 				
 				concepts_tokens = probabilities_to_c1_c2(probability_concept)
-				question_punctuation_split = split_words_punctuation(user_status[chat_id].question)
+				# (the question has already been tokenized by the vocabularies)
+				question_punctuation_split = tokenize(user_status[chat_id].question).tokens
 				
 				answer = ""
 				
@@ -265,8 +355,7 @@ def handle(msg):
 			user_status[chat_id].status = USER_STATUS.STARTING_CONVERSATION
 		elif user_status[chat_id].status == USER_STATUS.ANSWERING_QUESTION:
 			answer = msg["text"]
-			answer_split = answer.split()
-			answer_punctuation_split = split_words_punctuation(answer)
+			answer_tokenization = tokenize(answer)
 			bot.sendMessage(chat_id, "Alright! Thanks!")
 			
 			if user_status[chat_id].question_data["type"] == "XY":
@@ -276,40 +365,26 @@ def handle(msg):
 				data_c2 = user_status[chat_id].question_data["c2"] + "::" + c2
 			elif user_status[chat_id].question_data["type"] == "X":
 				c1 = user_status[chat_id].question_data["id1"]
-				with graph.as_default():
-					c2_probability_concept = concept_extractor_answer.predict(np.array(concept_extractor_answer_vocabulary.sentence2indices(answer)))
+				c2_probability_concept = concept_extractor_answer_predictor.predict(np.array(concept_extractor_answer_vocabulary.sentence2indices(answer)))
 				#print(c2_probability_concept)
 				c2_tokens = probabilities_to_concept_tokens(c2_probability_concept)
 				#print("c2_tokens:", c2_tokens)
-				# NN tokens indices to BabelNet token indices:
-				for idx, w in enumerate(answer_split):
-					if answer_punctuation_split[c2_tokens[0]] in w:
-						c2_tokens[0] = idx
-						break
-				for idx, w in enumerate(answer_split):
-					if answer_punctuation_split[c2_tokens[1]] in w:
-						c2_tokens[1] = idx
+				# NN tokens indices to BabelNet token indices (words of answer.split()):
+				c2_tokens = [answer_tokenization.word_indices[i] for i in c2_tokens]
 				#print("c2_tokens:", c2_tokens)
-				c2 = babelfy_disambiguate(answer, c2_tokens[0], c2_tokens[1])
+				c2 = babelNetLoop.run(babelNetClient.disambiguate_span(answer, c2_tokens[0], c2_tokens[1]))
 				data_c1 = user_status[chat_id].question_data["c1"] + "::" + c1
 				data_c2 = c2
 			else:
 				c2 = user_status[chat_id].question_data["id2"]
-				with graph.as_default():
-					c1_probability_concept = concept_extractor_answer.predict(np.array(concept_extractor_answer_vocabulary.sentence2indices(answer)))
+				c1_probability_concept = concept_extractor_answer_predictor.predict(np.array(concept_extractor_answer_vocabulary.sentence2indices(answer)))
 				#print(c1_probability_concept)
 				c1_tokens = probabilities_to_concept_tokens(c1_probability_concept)
 				print("c1_tokens:", c1_tokens)
-				# NN tokens indices to BabelNet token indices:
-				for idx, w in enumerate(answer_split):
-					if answer_punctuation_split[c1_tokens[0]] in w:
-						c1_tokens[0] = idx
-						break
-				for idx, w in enumerate(answer_split):
-					if answer_punctuation_split[c1_tokens[1]] in w:
-						c1_tokens[1] = idx
+				# NN tokens indices to BabelNet token indices (words of answer.split()):
+				c1_tokens = [answer_tokenization.word_indices[i] for i in c1_tokens]
 				#print("c1_tokens:", c1_tokens)
-				c1 = babelfy_disambiguate(answer, c1_tokens[0], c1_tokens[1])
+				c1 = babelNetLoop.run(babelNetClient.disambiguate_span(answer, c1_tokens[0], c1_tokens[1]))
 				data_c1 = c1
 				data_c2 = user_status[chat_id].question_data["c2"] + "::" + c2
 			data = {
@@ -322,21 +397,13 @@ def handle(msg):
 				"c2": data_c2
 			}
 
+			print("Babelfy cache:", babelfyCache.stats())
 			print("Enriching KB with:")
 			print(data)
 
-			conn = http.client.HTTPConnection(SERVER_IP_ADDRESS, SERVER_PORT)
-			conn.request("POST",
-						 SERVER_PATH + "add_item_test?key=" + BABELNET_KEY,
-						 json.dumps(data),
-						 {"Content-type": "application/json"})
-
-			# TODO: manage answer from server (1/-1) and errors
-			r1 = conn.getresponse()
-			conn.close()
-			print(r1.status, r1.reason)
-			data1 = r1.read()
-			print(data1)
+			# Sent to the server in background:
+			kbEnrichmentWriter.add(data)
+			print("KB enrichment:", kbEnrichmentWriter.stats())
 
 			user_status[chat_id].status = USER_STATUS.STARTING_CONVERSATION
 
@@ -344,7 +411,13 @@ def handle(msg):
 			bot.sendMessage(chat_id, "What would you like to talk about?")
 			user_status[chat_id].status = USER_STATUS.CHOOSING_DOMAIN
 
-MessageLoop(bot, handle).run_as_thread()
+if USE_ASYNCIO:
+	# The messages are queued by chat in the event loop of the BabelNet client
+	# and handled by a pool of threads (one message at a time for each chat):
+	chatDispatcher = ChatDispatcher(handle, babelNetLoop.loop, BOT_WORKERS)
+	MessageLoop(bot, chatDispatcher.submit).run_as_thread()
+else:
+	MessageLoop(bot, handle).run_as_thread()
 print("The bot is ready.")
 
 # Keep the program running:
@@ -353,5 +426,3 @@ while 1:
 
 # TODO: create a thread to take commands from command line
 #		e.g. close the bot
-# TODO: # Save the cache with the new elements found from the queries:
-#		babelNetCache.save()
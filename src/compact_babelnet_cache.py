@@ -0,0 +1,11 @@
+# Merge the logs of the BabelNet and Babelfy caches (written by the bot while
+# it is running) into the cache files, run the program (while the bot is not running) by typing:
+#     python3 compact_babelnet_cache.py
+
+from BabelfyCache import BabelfyCache
+from BabelNetCache import BabelNetCache
+
+for cache in [BabelNetCache("../resources/babelnet_cache.tsv"), BabelfyCache("../resources/babelfy_cache.tsv")]:
+	print("Compacting " + cache.cache_file_path + " (" + str(len(cache.cache)) + " elements)...")
+	cache.compact()
+	print("Done.")
@@ -0,0 +1,17 @@
+# Compile the knowledge base (elements, concepts resolved with the BabelNet cache
+# and search index) into a binary snapshot that KnowledgeBase opens with mmap,
+# run the program by typing:
+#     python3 compile_kb.py ../resources/kb.json ../resources/kb.snapshot
+
+import sys
+
+from BabelNetCache import BabelNetCache
+from KnowledgeBase import KnowledgeBase
+from KnowledgeBaseSnapshot import save_snapshot
+
+babelNetCache = BabelNetCache("../resources/babelnet_cache.tsv")
+knowledgeBase = KnowledgeBase(sys.argv[1], babelNetCache)
+
+print("Writing " + sys.argv[2] + "...")
+save_snapshot(knowledgeBase, sys.argv[2], sys.argv[1])
+print("Done.")
@@ -0,0 +1,94 @@
+# Compare the Seq2Seq model used by the bot with its version quantized to int8
+# (bot.py --seq2seq --quantize): size, time to answer a question and loss/accuracy
+# on the test buckets of train.py, run the program (on CPU) by typing (e.g.):
+#     python3 evaluate_quantization.py ../models/hparams.json [N_ANSWERS]
+
+import io
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from CompactKnowledgeBase import CompactKnowledgeBase
+from utils import *
+from Vocabulary import Vocabulary
+
+from seq2seq.BucketSampler import BucketSampler
+from seq2seq.Seq2Seq import Seq2Seq
+import seq2seq.utils
+
+# HParams from json file (command line args):
+with open(sys.argv[1]) as hparams_file:
+	hparams = json.load(hparams_file)
+hparams_answer_generator = hparams["answerGenerator"]
+n_answers = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+# Test buckets (as in train.py):
+print("Loading the knowledge base...")
+knowledge_base = CompactKnowledgeBase("../resources/kb.json")
+print("Done.")
+vocabulary_small = Vocabulary(hparams_answer_generator["encoderVocabularyPath"])
+vocabulary_big = Vocabulary(hparams_answer_generator["decoderVocabularyPath"])
+
+kb_len = int(len(knowledge_base) * hparams_answer_generator["kbLenPercentage"])
+X, Y = answer_generator_dataset(knowledge_base[:kb_len], vocabulary_big, vocabulary_small)
+X_train, Y_train, X_dev, Y_dev, X_test, Y_test = split_dataset(X, Y, hparams_answer_generator["kbSplit"])
+buckets_dims = [10, 20, 50, max([len(y) for y in Y])]
+pad_symbol_idx = vocabulary_small.word2index[vocabulary_small.PAD_SYMBOL]
+test_batches = BucketSampler(X_test, Y_test, buckets_dims, hparams_answer_generator["batchSize"],
+							 shuffle=False, pad_symbol_idx=pad_symbol_idx)
+
+# Model (as in bot.py). The loss/accuracy are computed by a copy of the model in "train" mode
+# (without teacher forcing, so it's fed with its own predictions as in "eval" mode): in "eval"
+# mode the decoding stops when the first answer of the batch ends, and the targets would be cut:
+vocabulary_encoder = Vocabulary(hparams_answer_generator["encoderVocabularyPath"])
+vocabulary_decoder = Vocabulary(hparams_answer_generator["decoderVocabularyPath"])
+state_dict = torch.load(hparams_answer_generator["checkpoint"], map_location=lambda storage, loc:storage)["state_dict"]
+
+def load_model(mode):
+	model = Seq2Seq(mode,
+					vocabulary_encoder.VOCABULARY_DIM, vocabulary_decoder.VOCABULARY_DIM,
+					vocabulary_decoder.word2index[vocabulary_decoder.PAD_SYMBOL],
+					vocabulary_decoder.word2index[vocabulary_decoder.GO_SYMBOL],
+					vocabulary_decoder.word2index[vocabulary_decoder.EOS_SYMBOL],
+					hparams_answer_generator["encoderHiddenSize"],
+					hparams_answer_generator["decoderHiddenSize"],
+					300,
+					embedding_padding_idx=vocabulary_decoder.word2index[vocabulary_decoder.PAD_SYMBOL],
+					teacher_forcing=False)
+	model.load_state_dict(OrderedDict([(k, v) for k, v in state_dict.items() if not k.endswith("l1")]))
+	return model
+
+seq2seq_model = load_model("eval")
+quantized_model = seq2seq.utils.quantize(seq2seq_model)
+loss_model = load_model("train")
+quantized_loss_model = seq2seq.utils.quantize(loss_model)
+
+criterion = torch.nn.NLLLoss(ignore_index=seq2seq_model.embedding_padding_idx)
+
+# Size of the weights (in MB):
+def model_size(model):
+	buf = io.BytesIO()
+	torch.save(model.state_dict(), buf)
+	return len(buf.getvalue()) / 2**20
+
+# Questions answered one at a time (as the bot does):
+questions = [x.numpy().copy() for x, _ in BucketSampler(X_test, Y_test, buckets_dims, 1, shuffle=False)][:n_answers]
+
+answers = {}
+for name, model, free_running_model in [("float32", seq2seq_model, loss_model), ("int8", quantized_model, quantized_loss_model)]:
+	print("Evaluating the " + name + " model...")
+	loss, accuracy = seq2seq.utils.evaluate(free_running_model, criterion, test_batches)
+
+	start = time.perf_counter()
+	answers[name] = [model.predict(q) for q in questions]
+	latency = (time.perf_counter() - start) / max(len(questions), 1) * 1000
+
+	print(name + " | Size: %.1f MB | Latency: %.2f ms/answer | Test Loss: %2.3f | Test Accuracy: %2.3f%%" %
+		  (model_size(model), latency, loss, accuracy*100))
+
+same_answers = sum([1 for a, b in zip(answers["float32"], answers["int8"]) if np.array_equal(a, b)])
+print("Same answers: " + str(same_answers) + "/" + str(len(questions)))
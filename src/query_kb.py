@@ -1,10 +1,10 @@
-import json
 import random
 
+from CompactKnowledgeBase import CompactKnowledgeBase
+
 # Open the Knowledge Base:
 print("Loading the knowledge base...")
-with open("../resources/kb.json") as kb_file:
-	knowledge_base = json.load(kb_file)
+knowledge_base = CompactKnowledgeBase("../resources/kb.json")
 print("Done.")
 
 while True:
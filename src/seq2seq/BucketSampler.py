@@ -0,0 +1,117 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+# Batches of (question, answer) pairs for training and evaluating Seq2Seq.
+# Every pair is put in exactly one bucket, the first one whose dimension is
+# at least the length of the answer (the last bucket takes the longer answers).
+# The batches are taken from one bucket at a time (the order of the pairs in
+# a bucket is shuffled at every epoch if shuffle is True) and padded to their
+# longest question and answer: the questions are reversed (to increase the amount
+# of short term dependencies) and padded at the beginning, the answers are padded
+# at the end. The batches are written into arrays allocated once and shared with
+# the torch tensors (so a batch is valid until the next one is requested), and
+# if prefetch > 0 up to prefetch batches are prepared by a worker thread while
+# the previous ones are used:
+class BucketSampler:
+	def __init__(self, X, Y, dims, batch_size=32, shuffle=True, prefetch=0, pad_symbol_idx=0, seed=None):
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.prefetch = prefetch
+		self.pad_symbol_idx = pad_symbol_idx
+		self.random = np.random.RandomState(seed)
+
+		# Samples of each bucket:
+		bucket_samples = [[] for _ in range(len(dims))]
+		for x, y in zip(X, Y):
+			idx = next((i for i, d in enumerate(dims) if len(y) <= d), len(dims) - 1)
+			bucket_samples[idx].append((x, y))
+
+		# Each bucket is stored as two arrays padded to its longest question (at
+		# the beginning, reversed) and answer (at the end) plus the lengths:
+		self.buckets = []
+		for samples in bucket_samples:
+			if not samples:
+				continue
+			len_x = np.array([len(x) for x, _ in samples])
+			len_y = np.array([len(y) for _, y in samples])
+			bucket_x = np.full((len(samples), len_x.max()), pad_symbol_idx, dtype=np.int64)
+			bucket_y = np.full((len(samples), len_y.max()), pad_symbol_idx, dtype=np.int64)
+			for i, (x, y) in enumerate(samples):
+				bucket_x[i, bucket_x.shape[1]-len(x):] = x[::-1]
+				bucket_y[i, :len(y)] = y
+			self.buckets.append((bucket_x, bucket_y, len_x, len_y))
+
+		self.n_samples = sum([len(bucket_x) for bucket_x, _, _, _ in self.buckets])
+
+		# Arrays of the batches (one for each batch that can be prepared while the
+		# previous one is used):
+		max_len_x = max([bucket_x.shape[1] for bucket_x, _, _, _ in self.buckets], default=0)
+		max_len_y = max([bucket_y.shape[1] for _, bucket_y, _, _ in self.buckets], default=0)
+		self.batch_arrays = [(np.empty(batch_size * max_len_x, dtype=np.int64),
+							  np.empty(batch_size * max_len_y, dtype=np.int64))
+							 for _ in range(prefetch + 2)]
+
+	# Number of batches of an epoch:
+	def __len__(self):
+		return sum([(len(bucket_x) + self.batch_size - 1) // self.batch_size for bucket_x, _, _, _ in self.buckets])
+
+	# Iterate over the batches of an epoch as pairs of LongTensors (x, y) of
+	# shapes (batch_size, max_len_x) and (batch_size, max_len_y) of the batch:
+	def __iter__(self):
+		if self.prefetch <= 0:
+			yield from self._batches()
+			return
+
+		batches = queue.Queue(self.prefetch)
+		stop = threading.Event()
+
+		def prefetch():
+			try:
+				for batch in self._batches():
+					batches.put(batch)
+					if stop.is_set():
+						return
+				batches.put(None)
+			except Exception as e:
+				batches.put(e)
+
+		thread = threading.Thread(target=prefetch, daemon=True)
+		thread.start()
+		try:
+			while True:
+				batch = batches.get()
+				if batch is None:
+					break
+				if isinstance(batch, Exception):
+					raise batch
+				yield batch
+		finally:
+			# (The iteration has been interrupted, let the worker thread finish)
+			stop.set()
+			while thread.is_alive():
+				try:
+					batches.get_nowait()
+				except queue.Empty:
+					thread.join(0.01)
+
+	def _batches(self):
+		n_batches = 0
+		for bucket_x, bucket_y, len_x, len_y in self.buckets:
+			order = self.random.permutation(len(bucket_x)) if self.shuffle else np.arange(len(bucket_x))
+			for start in range(0, len(order), self.batch_size):
+				idx = order[start:start+self.batch_size]
+				array_x, array_y = self.batch_arrays[n_batches % len(self.batch_arrays)]
+				n_batches += 1
+
+				# Contiguous views of the arrays with the shape of the batch:
+				batch_len_x = len_x[idx].max()
+				batch_len_y = len_y[idx].max()
+				x = array_x[:len(idx) * batch_len_x].reshape(len(idx), batch_len_x)
+				y = array_y[:len(idx) * batch_len_y].reshape(len(idx), batch_len_y)
+				np.take(bucket_x[:, bucket_x.shape[1]-batch_len_x:], idx, axis=0, out=x)
+				np.take(bucket_y[:, :batch_len_y], idx, axis=0, out=y)
+
+				yield torch.from_numpy(x), torch.from_numpy(y)
@@ -17,7 +17,8 @@ class Seq2Seq(torch.nn.Module):
 				 embedding_dim,
 				 embedding_matrix_encoder=None, embedding_matrix_decoder=None,
 				 embedding_padding_idx=None,
-				 n_layers=1, bidirectional=False):
+				 n_layers=1, bidirectional=False,
+				 teacher_forcing=True):
 		
 		super(Seq2Seq, self).__init__()
 		
@@ -31,6 +32,8 @@ class Seq2Seq(torch.nn.Module):
 		
 		# hparams:
 		self.mode = mode
+		# Train feeding the decoder with the target words (instead of its own predictions):
+		self.teacher_forcing = teacher_forcing
 		self.target_vocabulary_dim = target_vocabulary_dim
 		self.embedding_padding_idx = embedding_padding_idx
 		#bidirectional = False
@@ -68,7 +71,9 @@ class Seq2Seq(torch.nn.Module):
 	# output shape (list of tensors): (batch_size, target_length, target_vocabulary_dim)
 	# if target_length=None then forward will be treated as in eval mode (i.e.
 	# outpus shape will be of shape (1, length), which is the answer to the question)
-	def forward(self, encoder_input, decoder_input, target_length):
+	# if target (shape: (batch_size, target_length)) is specified in train mode the
+	# decoder is teacher forced and the output is a tensor (see _teacher_forced_forward)
+	def forward(self, encoder_input, decoder_input, target_length, target=None):
 		
 		batch_size = encoder_input.size()[0]
 		
@@ -76,6 +81,9 @@ class Seq2Seq(torch.nn.Module):
 
 		encoder_output, encoder_hidden = self._encoder_forward(encoder_input)
 
+		if self.mode == "train" and target is not None:
+			return self._teacher_forced_forward(decoder_input, encoder_hidden, target)
+
 		#decoder_input = torch.autograd.Variable(torch.LongTensor([[self.GO_SYMBOL_IDX] * encoder_input.size()[0]]))
 		#decoder_input = decoder_input.cuda() if torch.cuda.is_available() else decoder_input
 
@@ -84,10 +92,7 @@ class Seq2Seq(torch.nn.Module):
 		if self.mode == "train":
 			for di in range(target_length):
 				decoder_output, decoder_hidden = self._decoder_forward(decoder_input, decoder_hidden)
-				topv, topi = decoder_output.data.topk(1)
-
-				decoder_input = torch.autograd.Variable(torch.LongTensor(topi.cpu()), volatile=self.volatile)
-				decoder_input = decoder_input.cuda() if torch.cuda.is_available() else decoder_input
+				decoder_input = decoder_output.detach().argmax(1, keepdim=True)
 
 				output_data.append(decoder_output)
 		else:
@@ -109,14 +114,102 @@ class Seq2Seq(torch.nn.Module):
 	
 		return output_data
 
+	# Greedy decoding of a batch of questions, encoder_input shape: (batch_size, encoder_seq_len)
+	# (questions shorter than encoder_seq_len padded at the beginning, as in training).
+	# Returns a LongTensor of shape (batch_size, length) with the ids of the answers
+	# (EOS included, followed by PAD), length <= target_length, the decoding stops when
+	# all the answers have reached EOS. If a Shortlist is specified only its candidates
+	# are scored (falling back to the whole vocabulary when needed, see Shortlist):
+	def decode(self, encoder_input, target_length, shortlist=None):
+		batch_size = encoder_input.size()[0]
+
+		encoder_output, decoder_hidden = self._encoder_forward(encoder_input)
+		decoder_input = encoder_input.new_full((batch_size, 1), self.GO_SYMBOL_IDX)
+		finished = torch.zeros(batch_size, dtype=torch.bool, device=encoder_input.device)
+
+		if shortlist is not None:
+			candidates, excluded = shortlist.candidates(encoder_input)
+			candidates_weight = self.decoder_out.weight[candidates]
+			candidates_bias = self.decoder_out.bias[candidates]
+
+		output_ids = []
+		for di in range(target_length):
+			if shortlist is None:
+				decoder_output, decoder_hidden = self._decoder_forward(decoder_input, decoder_hidden)
+				ids = decoder_output.argmax(1)
+			else:
+				decoder_state, decoder_hidden = self._decoder_state_forward(decoder_input, decoder_hidden)
+				# (the log-softmax doesn't change the argmax)
+				logits = torch.nn.functional.linear(decoder_state, candidates_weight, candidates_bias)
+				logits.masked_fill_(excluded, float("-inf"))
+				max_probability, best = torch.softmax(logits, 1).max(1)
+				ids = candidates[best]
+				fallback = max_probability < shortlist.fallback_probability
+				if fallback.any():
+					ids[fallback] = self.decoder_out(decoder_state[fallback]).argmax(1)
+			ids = ids.masked_fill(finished, self.PAD_SYMBOL_IDX)
+			output_ids.append(ids)
+
+			finished |= ids == self.EOS_SYMBOL_IDX
+			if finished.all():
+				break
+			decoder_input = ids.unsqueeze(1)
+
+		return torch.stack(output_ids, 1)
+
+	# Same as decode for a numpy array of ids (e.g. used by BatchPredictor),
+	# returns a numpy array:
+	def predict(self, x, batch_size=None, target_length=30, shortlist=None):
+		encoder_input = torch.from_numpy(x).long().to(self.encoder_embedding.weight.device)
+		with torch.no_grad():
+			return self.decode(encoder_input, target_length, shortlist).cpu().numpy()
+
+	# The questions padded at the beginning are packed, so the GRU doesn't run over
+	# the padding (encoder_output is padded at the end). Only the leading padding is
+	# removed, the unknown words have the same index and can be inside the question:
 	def _encoder_forward(self, input):
 		embedded = self.encoder_embedding(input)
-		return self.encoder_gru(embedded)
+		seq_len = input.size()[1]
+		lengths = (seq_len - ((input != self.PAD_SYMBOL_IDX).cumsum(1) == 0).sum(1)).clamp(min=1)
+		if (lengths == seq_len).all():
+			return self.encoder_gru(embedded)
+
+		# Move the words to the beginning:
+		positions = (torch.arange(seq_len, device=input.device) + (seq_len - lengths).unsqueeze(1)) % seq_len
+		embedded = embedded.gather(1, positions.unsqueeze(2).expand(-1, -1, embedded.size()[2]))
+		packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, lengths.cpu(), batch_first=True, enforce_sorted=False)
+		output, hidden = self.encoder_gru(packed)
+		output, _ = torch.nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=seq_len)
+		return output, hidden
+
+	# Decoder fed with GO followed by the words of target (batch_size, target_length),
+	# returns the log-probabilities of shape (batch_size, target_length, target_vocabulary_dim).
+	# A unidirectional decoder processes the whole sequence with a single call of the GRU
+	# (a bidirectional one would see the next words, so it goes one step at a time):
+	def _teacher_forced_forward(self, decoder_input, decoder_hidden, target):
+		decoder_input = torch.cat([decoder_input, target[:, :-1]], 1)
+		if self.decoder_gru.bidirectional:
+			output_data = []
+			for di in range(decoder_input.size()[1]):
+				decoder_output, decoder_hidden = self._decoder_forward(decoder_input[:, di:di+1], decoder_hidden)
+				output_data.append(decoder_output)
+			return torch.stack(output_data, 1)
+
+		output = self.decoder_embedding(decoder_input)
+		output = torch.nn.functional.relu(output)
+		output, hidden = self.decoder_gru(output, decoder_hidden)
+		output = self.decoder_out(output)
+		return torch.nn.functional.log_softmax(output, 2)
 
 	def _decoder_forward(self, input, hidden):
+		output, hidden = self._decoder_state_forward(input, hidden)
+		output = self.decoder_out(output)
+		output = self.softmax(output)
+		return output, hidden
+
+	# Output of the decoder GRU (before decoder_out):
+	def _decoder_state_forward(self, input, hidden):
 		output = self.decoder_embedding(input)
 		output = torch.nn.functional.relu(output)
 		output, hidden = self.decoder_gru(output, hidden)
-		output = self.decoder_out(output[:,0,:self.decoder_hidden_size])
-		output = self.softmax(output)
-		return output, hidden
+		return output[:,0,:self.decoder_hidden_size], hidden
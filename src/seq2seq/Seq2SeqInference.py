@@ -0,0 +1,158 @@
+import torch
+
+# Greedy decoding of a Seq2Seq model for serving (same results as Seq2Seq.decode):
+#     * no autograd;
+#     * the decoder step is computed with the weights of the model writing into
+#       tensors allocated once (input, hidden state, logits, ids...), so no memory
+#       is allocated for each token (the buffers grow if a bigger batch arrives);
+#     * the log-softmax is skipped since it doesn't change the argmax;
+#     * if a Shortlist is specified only its candidates are scored (see Shortlist).
+# The encoder (run once for each question) uses the GRU of the model:
+class Seq2SeqInference:
+	def __init__(self, model, max_batch_size=64, target_length=30, shortlist=None):
+		self.model = model
+		self.target_length = target_length
+		self.shortlist = shortlist
+		self.PAD_SYMBOL_IDX = model.PAD_SYMBOL_IDX
+		self.EOS_SYMBOL_IDX = model.EOS_SYMBOL_IDX
+
+		gru = model.decoder_gru
+		self.n_layers = gru.num_layers
+		self.n_directions = 2 if gru.bidirectional else 1
+		self.hidden_size = gru.hidden_size
+
+		# Weights of the GRU for each layer and direction: (w_ih^T, w_hh^T, b_ih, b_hh)
+		self.gru_weights = []
+		for layer in range(self.n_layers):
+			for direction in range(self.n_directions):
+				suffix = "_l" + str(layer) + ("_reverse" if direction == 1 else "")
+				self.gru_weights.append((getattr(gru, "weight_ih" + suffix).detach().t(),
+										 getattr(gru, "weight_hh" + suffix).detach().t(),
+										 getattr(gru, "bias_ih" + suffix).detach(),
+										 getattr(gru, "bias_hh" + suffix).detach()))
+		self.embedding_weight = model.decoder_embedding.weight.detach()
+		self.out_weight = model.decoder_out.weight.detach().t()
+		self.out_bias = model.decoder_out.bias.detach()
+
+		self.device = self.embedding_weight.device
+		self.batch_size = 0
+		self._allocate(max_batch_size)
+
+	def _allocate(self, batch_size):
+		H = self.hidden_size
+		new_long = lambda *size: torch.empty(*size, dtype=torch.long, device=self.device)
+		new_float = lambda *size: torch.empty(*size, dtype=self.embedding_weight.dtype, device=self.device)
+
+		self.batch_size = batch_size
+		self.decoder_input = new_long(batch_size)
+		self.embedded = new_float(batch_size, self.embedding_weight.size()[1])
+		self.hidden = new_float(self.n_layers * self.n_directions, batch_size, H)
+		self.layer_input = new_float(batch_size, self.n_directions * H)
+		self.gi = new_float(batch_size, 3 * H)
+		self.gh = new_float(batch_size, 3 * H)
+		self.rz = new_float(batch_size, 2 * H)
+		self.n = new_float(batch_size, H)
+		self.logits = new_float(batch_size, self.out_weight.size()[1])
+		self.max_values = new_float(batch_size)
+		self.ids = new_long(batch_size)
+		self.is_eos = torch.empty(batch_size, dtype=torch.bool, device=self.device)
+		self.finished = torch.empty(batch_size, dtype=torch.bool, device=self.device)
+		self.output_ids = new_long(batch_size, self.target_length)
+
+	# Same as Seq2Seq.decode (target_length is the one of the constructor):
+	def decode(self, encoder_input):
+		with torch.no_grad():
+			batch_size = encoder_input.size()[0]
+			if batch_size > self.batch_size:
+				self._allocate(batch_size)
+
+			encoder_output, encoder_hidden = self.model._encoder_forward(encoder_input)
+			if self.shortlist is not None:
+				candidates, excluded = self.shortlist.candidates(encoder_input)
+				out_weight = self.out_weight[:, candidates]
+				out_bias = self.out_bias[candidates]
+			else:
+				out_weight = self.out_weight
+				out_bias = self.out_bias
+			hidden = self.hidden[:, :batch_size]
+			hidden.copy_(encoder_hidden)
+
+			decoder_input = self.decoder_input[:batch_size].fill_(self.model.GO_SYMBOL_IDX)
+			finished = self.finished[:batch_size].fill_(False)
+			ids = self.ids[:batch_size]
+			is_eos = self.is_eos[:batch_size]
+			output_ids = self.output_ids[:batch_size]
+
+			length = 0
+			while length < self.target_length:
+				decoder_state = self._decoder_step(decoder_input, hidden, batch_size)
+				logits = self.logits.view(-1)[:batch_size * out_weight.size()[1]].view(batch_size, -1)
+				torch.addmm(out_bias, decoder_state, out_weight, out=logits)
+				if self.shortlist is not None:
+					logits.masked_fill_(excluded, float("-inf"))
+				max_values = self.max_values[:batch_size]
+				torch.max(logits, 1, out=(max_values, ids))
+				if self.shortlist is not None:
+					self._shortlist_ids(candidates, logits, max_values, decoder_state, ids)
+				ids.masked_fill_(finished, self.PAD_SYMBOL_IDX)
+				output_ids[:, length].copy_(ids)
+				length += 1
+
+				torch.eq(ids, self.EOS_SYMBOL_IDX, out=is_eos)
+				finished.logical_or_(is_eos)
+				if finished.all():
+					break
+				decoder_input.copy_(ids)
+
+			return output_ids[:, :length].clone()
+
+	# Same as Seq2Seq.predict:
+	def predict(self, x, batch_size=None):
+		encoder_input = torch.from_numpy(x).long().to(self.device)
+		return self.decode(encoder_input).cpu().numpy()
+
+	# Map the best candidates to the target ids, the rows where the probability
+	# of the best candidate is too low are scored with the whole vocabulary:
+	def _shortlist_ids(self, candidates, logits, max_values, decoder_state, ids):
+		ids.copy_(candidates[ids])
+		max_probability = (max_values - torch.logsumexp(logits, 1)).exp_()
+		fallback = max_probability < self.shortlist.fallback_probability
+		if fallback.any():
+			ids[fallback] = torch.addmm(self.out_bias, decoder_state[fallback], self.out_weight).argmax(1)
+
+	# Seq2Seq._decoder_state_forward for a sequence of length 1, updates hidden
+	# in place and returns the output of the GRU:
+	def _decoder_step(self, decoder_input, hidden, batch_size):
+		H = self.hidden_size
+		embedded = self.embedded[:batch_size]
+		torch.index_select(self.embedding_weight, 0, decoder_input, out=embedded)
+		embedded.relu_()
+
+		layer_input = embedded
+		for layer in range(self.n_layers):
+			for direction in range(self.n_directions):
+				i = layer * self.n_directions + direction
+				w_ih, w_hh, b_ih, b_hh = self.gru_weights[i]
+				h = hidden[i]
+				gi = self.gi[:batch_size]
+				gh = self.gh[:batch_size]
+				rz = self.rz[:batch_size]
+				n = self.n[:batch_size]
+
+				# r, z = sigmoid(W_i x + b_i + W_h h + b_h), n = tanh(W_in x + b_in + r * (W_hn h + b_hn)),
+				# h = (1 - z) * n + z * h = n + z * (h - n):
+				torch.addmm(b_ih, layer_input, w_ih, out=gi)
+				torch.addmm(b_hh, h, w_hh, out=gh)
+				torch.add(gi[:, :2*H], gh[:, :2*H], out=rz)
+				rz.sigmoid_()
+				torch.mul(rz[:, :H], gh[:, 2*H:], out=n)
+				n.add_(gi[:, 2*H:]).tanh_()
+				h.sub_(n).mul_(rz[:, H:]).add_(n)
+
+			if layer < self.n_layers - 1:
+				layer_input = self.layer_input[:batch_size]
+				for direction in range(self.n_directions):
+					layer_input[:, direction*H:(direction+1)*H].copy_(hidden[layer * self.n_directions + direction])
+
+		# Output of the forward direction of the last layer:
+		return hidden[(self.n_layers - 1) * self.n_directions]
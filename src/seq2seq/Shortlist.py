@@ -0,0 +1,50 @@
+import json
+from collections import Counter
+
+import torch
+
+# Candidate words of the answers used to decode Seq2Seq scoring only a few rows
+# of decoder_out instead of the whole target vocabulary: the most frequent words
+# of the answers of the training set plus the words of the question being answered
+# (mapped from the input vocabulary to the target vocabulary) and the special symbols.
+# If the model is not confident about the best candidate (its probability among the
+# candidates is less than fallback_probability) the whole vocabulary is scored:
+class Shortlist:
+	def __init__(self, frequent_ids, input_vocabulary, target_vocabulary, special_ids, fallback_probability=0.1):
+		self.fallback_probability = fallback_probability
+		self.frequent_ids = torch.LongTensor(sorted(set(frequent_ids) | set(special_ids)))
+
+		# input id -> target id (-1 if the word is not in the target vocabulary):
+		self.input_to_target = torch.full((input_vocabulary.VOCABULARY_DIM,), -1, dtype=torch.long)
+		for word, input_id in input_vocabulary.word2index.items():
+			if word in target_vocabulary.word2index:
+				self.input_to_target[input_id] = target_vocabulary.word2index[word]
+		# (the padding of the questions in a batch isn't a word of the question)
+		self.input_to_target[input_vocabulary.word2index[input_vocabulary.PAD_SYMBOL]] = -1
+
+	# Return the (sorted) target ids that can be predicted for the batch of questions
+	# and a mask of shape (batch_size, n_candidates), True where the candidate can't be
+	# predicted for the question (a word of another question of the batch), so the
+	# answer of a question doesn't depend on the questions batched with it:
+	def candidates(self, encoder_input):
+		question_ids = self.input_to_target[encoder_input.cpu()]
+		candidates = torch.cat([self.frequent_ids, question_ids[question_ids != -1]]).unique()
+
+		excluded = torch.ones(question_ids.size()[0], len(candidates), dtype=torch.bool)
+		excluded[:, torch.searchsorted(candidates, self.frequent_ids)] = False
+		rows, positions = (question_ids != -1).nonzero(as_tuple=True)
+		excluded[rows, torch.searchsorted(candidates, question_ids[rows, positions])] = False
+		return candidates.to(encoder_input.device), excluded.to(encoder_input.device)
+
+# Return the size most frequent ids of the answers Y (lists of ids):
+def frequent_answer_ids(Y, size=1000, pad_symbol_idx=0):
+	counter = Counter([i for y in Y for i in y if i != pad_symbol_idx])
+	return [i for i, _ in counter.most_common(size)]
+
+def save_shortlist(frequent_ids, path):
+	with open(path, "w") as shortlist_file:
+		json.dump([int(i) for i in frequent_ids], shortlist_file)
+
+def load_shortlist(path):
+	with open(path) as shortlist_file:
+		return json.load(shortlist_file)
@@ -1,9 +1,11 @@
 import torch
 import shutil
 
+# Train the network on the batches of a BucketSampler (validation_data
+# is the BucketSampler of the dev set):
 def train(model, optimizer, criterion,
-		  bucket_list_X, bucket_list_Y,
-		  batch_size=32, epochs=10,
+		  batches,
+		  epochs=10,
 		  validation_data=None,
 		  checkpoint_dir=None,
 		  early_stopping_max=None,
@@ -11,13 +13,8 @@ def train(model, optimizer, criterion,
 		  starting_iter=0,
 		  best_acc=0):
 	
-	# Check if dev set is defined:
-	if validation_data is not None:
-		dev_bucket_list_X = validation_data[0]
-		dev_bucket_list_Y = validation_data[1]
-	
 	# Used to count tot. number of iterations:
-	tot_sentences = sum([len(b) for b in bucket_list_X])
+	tot_sentences = batches.n_samples
 
 	# Early stopping counter (epochs without improvements):
 	early_stopping_cnt = 0
@@ -38,59 +35,53 @@ def train(model, optimizer, criterion,
 		tot_loss = 0
 		sentences_train_cnt = 0
 	
-		for X, Y in zip(bucket_list_X, bucket_list_Y):
-			for idx in range(0, len(X), batch_size):
-			
-				# Update iter_cnt:
-				iter_cnt += 1
-				if iter_cnt < starting_iter:
-					continue
+		for x, y in batches:
+			# Update iter_cnt:
+			iter_cnt += 1
+			if iter_cnt < starting_iter:
+				continue
+
+			if torch.cuda.is_available():
+				x = x.cuda()
+				y = y.cuda()
 			
-				# Init tensors:
-				x = torch.autograd.Variable(torch.LongTensor(X[idx:min(idx+batch_size, len(X))]), volatile=model.volatile)
-				y = torch.autograd.Variable(torch.LongTensor(Y[idx:min(idx+batch_size, len(Y))]), volatile=model.volatile)
-				
-				if torch.cuda.is_available():
-					x = x.cuda()
-					y = y.cuda()
-				
-				optimizer.zero_grad()
-
-				sentences_train_cnt += x.size()[0]
-
-				loss, correct_predicted_words_c, words_train_c = _compute_loss(model, criterion, x, y)
-				tot_loss += loss.data[0]
-				correct_predicted_words_cnt += correct_predicted_words_c
-				words_train_cnt += words_train_c
-
-				# Print current status of training:
-				# TODO: if you start from the middle of an epoch the iter value
-				#		is wrong because it considers sentences_train_cnt and not
-				#		iter_cnt
-				training_loss = tot_loss / sentences_train_cnt
-				training_accuracy = correct_predicted_words_cnt / words_train_cnt
-				print("Iter: %2.3f%% | Training Loss: %2.3f | Training Accuracy: %2.3f%%" %
-					  (sentences_train_cnt/tot_sentences*100, training_loss, training_accuracy*100),
-					  end="\r")
-
-				# Compute gradients:
-				loss.backward()
-
-				# Update the parameters of the network:
-				optimizer.step()
+			optimizer.zero_grad()
+
+			sentences_train_cnt += x.size()[0]
+
+			loss, correct_predicted_words_c, words_train_c = _compute_loss(model, criterion, x, y, model.teacher_forcing)
+			tot_loss += loss.item()
+			correct_predicted_words_cnt += correct_predicted_words_c
+			words_train_cnt += words_train_c
+
+			# Print current status of training:
+			# TODO: if you start from the middle of an epoch the iter value
+			#		is wrong because it considers sentences_train_cnt and not
+			#		iter_cnt
+			training_loss = tot_loss / sentences_train_cnt
+			training_accuracy = correct_predicted_words_cnt / words_train_cnt
+			print("Iter: %2.3f%% | Training Loss: %2.3f | Training Accuracy: %2.3f%%" %
+				  (sentences_train_cnt/tot_sentences*100, training_loss, training_accuracy*100),
+				  end="\r")
+
+			# Compute gradients:
+			loss.backward()
+
+			# Update the parameters of the network:
+			optimizer.step()
 	
-				# Save model after 1000 iterations:
-				if iter_cnt % 1000 == 0 and checkpoint_dir:
-					state = {
-						"epoch": epoch+1,
-						"iter": iter_cnt+1,
-						"state_dict": model.state_dict(),
-						"best_acc": best_acc,
-						"optimizer": optimizer.state_dict()
-					}
-					
-					filename = checkpoint_dir + "/seq2seq_epoch_" + str(epoch+1) + "_iter_" + str(iter_cnt+1) + ".pth.tar"
-					save_checkpoint(state, filename)
+			# Save model after 1000 iterations:
+			if iter_cnt % 1000 == 0 and checkpoint_dir:
+				state = {
+					"epoch": epoch+1,
+					"iter": iter_cnt+1,
+					"state_dict": model.state_dict(),
+					"best_acc": best_acc,
+					"optimizer": optimizer.state_dict()
+				}
+				
+				filename = checkpoint_dir + "/seq2seq_epoch_" + str(epoch+1) + "_iter_" + str(iter_cnt+1) + ".pth.tar"
+				save_checkpoint(state, filename)
 
 		print("")
 
@@ -101,7 +92,7 @@ def train(model, optimizer, criterion,
 
 		# Compute loss and accuracy on dev set:
 		if validation_data:
-			validation_loss, validation_accuracy = evaluate(model, criterion, dev_bucket_list_X, dev_bucket_list_Y, batch_size)
+			validation_loss, validation_accuracy = evaluate(model, criterion, validation_data)
 			print("Validation Loss: %2.3f | Validation Accuracy: %2.3f%%" % (validation_loss, validation_accuracy*100))
 			is_best = best_acc < validation_accuracy
 			best_acc = max(best_acc, validation_accuracy)
@@ -139,12 +130,12 @@ def train(model, optimizer, criterion,
 		starting_iter = 0
 
 
-# Evaluate the network on a list of buckets,
+# Evaluate the network on the batches of a BucketSampler,
 # returns loss and accuracy:
-def evaluate(model, criterion, bucket_list_X, bucket_list_Y, batch_size=32):
+def evaluate(model, criterion, batches):
 
 	# Used to count tot. number of iterations:
-	tot_sentences = sum([len(b) for b in bucket_list_X])
+	tot_sentences = batches.n_samples
 
 	# Used to compute accuracy over buckets:
 	correct_predicted_words_cnt = 0
@@ -154,58 +145,59 @@ def evaluate(model, criterion, bucket_list_X, bucket_list_Y, batch_size=32):
 	tot_loss = 0
 	sentences_cnt = 0
 
-	for X, Y in zip(bucket_list_X, bucket_list_Y):
-		for idx in range(0, len(X), batch_size):
-			# Init tensors:
-			x = torch.autograd.Variable(torch.LongTensor(X[idx:min(idx+batch_size, len(X))]), volatile=True)
-			y = torch.autograd.Variable(torch.LongTensor(Y[idx:min(idx+batch_size, len(Y))]), volatile=True)
-			
-			if torch.cuda.is_available():
-				x = x.cuda()
-				y = y.cuda()
+	for x, y in batches:
+		if torch.cuda.is_available():
+			x = x.cuda()
+			y = y.cuda()
 
-			sentences_cnt += x.size()[0]
+		sentences_cnt += x.size()[0]
 
+		with torch.no_grad():
 			loss, correct_predicted_words_c, words_c = _compute_loss(model, criterion, x, y)
-			tot_loss += loss.data[0]
-			correct_predicted_words_cnt += correct_predicted_words_c
-			words_cnt += words_c
+		tot_loss += loss.item()
+		correct_predicted_words_cnt += correct_predicted_words_c
+		words_cnt += words_c
 
-			print("Iter: %2.3f%%" % (sentences_cnt/tot_sentences*100), end="\r")
+		print("Iter: %2.3f%%" % (sentences_cnt/tot_sentences*100), end="\r")
 
 	return tot_loss / sentences_cnt, correct_predicted_words_cnt / words_cnt
 
 # x and y are tensors of shape (batch_size, seq_len).
 # It performs a forward step of the whole seq2seq network computing
 # the loss, the tot. number of correct predicted words and the
-# total number of words (removes padding from counting):
-def _compute_loss(model, criterion, x, y):
+# total number of words (removes padding from counting), the decoder
+# is fed with y if teacher_forcing (with its own predictions otherwise):
+def _compute_loss(model, criterion, x, y, teacher_forcing=False):
 
 	encoder_input = x
-	decoder_input = torch.autograd.Variable(torch.LongTensor([[model.GO_SYMBOL_IDX]] * x.size()[0]), volatile=model.volatile)
-	decoder_input = decoder_input.cuda() if torch.cuda.is_available() else decoder_input
+	decoder_input = x.new_full((x.size()[0], 1), model.GO_SYMBOL_IDX)
 	target_length = y.size()[1]
-	list_y_p = model(encoder_input, decoder_input, target_length)
+	list_y_p = model(encoder_input, decoder_input, target_length, y if teacher_forcing else None)
 
-	correct_predicted_words_cnt = 0
-	words_cnt = 0
-	loss = 0
+	# Outputs of all steps (batch_size, n_steps, vocabulary_dim), in eval mode
+	# the network can stop before target_length:
+	y_p = list_y_p if torch.is_tensor(list_y_p) else torch.stack(list_y_p, 1)
+	y = y[:, :y_p.size()[1]]
 
-	for di, y_p in enumerate(list_y_p):
-		topv, topi = y_p.data.topk(1)
-		loss += criterion(y_p, y[:,di])
-	
-		# Compute number of correct predictions over current batch:
-		for word_pred, word_true in zip(topi, y[:,di]):
-			# NOTE: word_pred is a torch Tensor, word_true is a torch Variable.
-			word_pred = word_pred[0]
-			word_true = word_true.data[0]
-			if word_true != model.PAD_SYMBOL_IDX:
-				words_cnt += 1
-				if word_pred == word_true:
-					correct_predicted_words_cnt += 1
+	# Sum over the steps of the mean loss of the words of each step (as the NLLLoss
+	# criterion applied to every step), the steps with only padding have loss 0:
+	word_losses = torch.nn.functional.nll_loss(y_p.reshape(-1, y_p.size()[2]), y.reshape(-1),
+											   ignore_index=criterion.ignore_index, reduction="none").view(y.size())
+	n_step_words = (y != criterion.ignore_index).sum(0).clamp(min=1)
+	loss = (word_losses.sum(0) / n_step_words).sum()
+	mask = y != model.PAD_SYMBOL_IDX
+
+	# Compute number of correct predictions over current batch:
+	correct_predicted_words_cnt = ((y_p.detach().argmax(2) == y) & mask).sum().item()
+	words_cnt = mask.sum().item()
 
 	return loss, correct_predicted_words_cnt, words_cnt
 
+# Return a copy of the model with the GRU and Linear layers dynamically quantized
+# to int8 (weights stored as int8, activations quantized at run time), the
+# quantized model runs only on CPU:
+def quantize(model):
+	return torch.quantization.quantize_dynamic(model.cpu(), {torch.nn.GRU, torch.nn.Linear}, dtype=torch.qint8)
+
 def save_checkpoint(state, filename):
     torch.save(state, filename)
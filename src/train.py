@@ -1,7 +1,11 @@
+import asyncio
 import json
 import sys
 
 from BabelNetCache import *
+from BabelNetClient import BabelNetClient
+from CompactKnowledgeBase import CompactKnowledgeBase
+from DatasetCache import DatasetCache
 from utils import *
 from Vocabulary import Vocabulary
 from Word2Vec import Word2Vec
@@ -14,52 +18,13 @@ from keras.preprocessing import sequence
 from keras.utils import np_utils
 
 import torch
+from seq2seq.BucketSampler import BucketSampler
 from seq2seq.Seq2Seq import Seq2Seq
+from seq2seq.Shortlist import frequent_answer_ids, save_shortlist
 import seq2seq.utils
 
 import numpy as np
 
-# Split dataset into training set (pSplit %), dev set
-# and test set (of equal dimension):
-def split_dataset(X, Y, pSplit):
-	X_train = X[:int(len(X) * pSplit)]
-	Y_train = Y[:int(len(Y) * pSplit)]
-	X_dev   = X[int(len(X) * pSplit):int(len(X) * (pSplit + 1) / 2)]
-	Y_dev   = Y[int(len(Y) * pSplit):int(len(Y) * (pSplit + 1) / 2)]
-	X_test  = X[int(len(X) * (pSplit + 1) / 2):]
-	Y_test  = Y[int(len(Y) * (pSplit + 1) / 2):]
-
-	return X_train, Y_train, X_dev, Y_dev, X_test, Y_test
-
-# Create buckets with padding given two sets and the dimensions of the buckets,
-# returns a list of buckets for X and a list of buckets for Y:
-def create_buckets(bucket_list_X, bucket_list_Y, dims):
-	bucket_x = [[] for _ in range(len(dims))]
-	bucket_y = [[] for _ in range(len(dims))]
-	padded_bucket_x = [[] for _ in range(len(dims))]
-	padded_bucket_y = [[] for _ in range(len(dims))]
-
-	# Put elements of X, Y in buckets depending
-	# on the length of the target sentence:
-	for x, y in zip(bucket_list_X, bucket_list_Y):
-		for idx, d in enumerate(dims):
-			if len(y) <= d:
-				bucket_x[idx].append(x)
-				bucket_y[idx].append(y)
-
-	# Add padding to buckets:
-	for idx, (bx, by) in enumerate(zip(bucket_x, bucket_y)):
-		max_len_x = max([len(x) for x in bx])
-		max_len_y = max([len(y) for y in by])
-		for x, y in zip(bx, by):
-			x[-1:-1] = [0] * (max_len_x - len(x))
-			y[-1:-1] = [0] * (max_len_y - len(y))
-			x.reverse() # use reversed sentence to increase amount of short term dependencies
-			padded_bucket_x[idx].append(x)
-			padded_bucket_y[idx].append(y)
-
-	return padded_bucket_x, padded_bucket_y
-
 # HParams from json file (command line args):
 with open(sys.argv[1]) as hparams_file:
 	hparams = json.load(hparams_file)
@@ -76,11 +41,29 @@ TRAIN_CONCEPT_EXTRACTOR_QUESTION = True
 TRAIN_CONCEPT_EXTRACTOR_ANSWER = False
 TRAIN_ANSWER_GENERATOR = False
 
-# Open the Knowledge Base:
-print("Loading the knowledge base...")
-with open("../resources/kb.json") as kb_file:
-	knowledge_base = json.load(kb_file)
-print("Done.")
+# Number of most frequent words of the answers in the shortlist of Seq2Seq:
+SEQ2SEQ_SHORTLIST_SIZE = 1000
+
+# Number of batches of Seq2Seq prepared by a worker thread during training:
+SEQ2SEQ_PREFETCH_BATCHES = 4
+
+# Knowledge Base and datasets built from it (cached until the KB or the vocabularies change,
+# delete the folder to build them again, e.g. after the BabelNet cache has been updated):
+KB_PATH = "../resources/kb.json"
+DATASET_CACHE_PATH = "../resources/datasets"
+
+# Number of processes building the datasets of the concept extractors (None: all the cores):
+DATASET_WORKERS = None
+
+# Open the Knowledge Base (only if a dataset has to be built):
+knowledge_base = None
+def get_knowledge_base():
+	global knowledge_base
+	if knowledge_base is None:
+		print("Loading the knowledge base...")
+		knowledge_base = CompactKnowledgeBase(KB_PATH)
+		print("Done.")
+	return knowledge_base
 
 # Vocabularies and Word2Vec:
 vocabulary_small = Vocabulary(hparams_answer_generator["encoderVocabularyPath"])
@@ -96,35 +79,72 @@ print("Done.")
 # BabelNet Cache:
 babelNetCache = BabelNetCache("../resources/babelnet_cache.tsv")
 
+dataset_cache = DatasetCache(DATASET_CACHE_PATH)
+
+# Return X and Y of the dataset name (built from the first kb_len_percentage of
+# the KB by build(elems) if it isn't in the cache), the sequences are SequenceColumns:
+def cached_dataset(name, vocabulary_paths, kb_len_percentage, build):
+	key = dataset_cache.key([KB_PATH] + vocabulary_paths, kb_len_percentage=kb_len_percentage)
+	dataset = dataset_cache.load(name, key)
+	if dataset is None:
+		kb = get_knowledge_base()
+		X, Y = build(kb[:int(len(kb) * kb_len_percentage)])
+		dataset_cache.save(name, key, X=X, Y=Y)
+		dataset = dataset_cache.load(name, key)
+	else:
+		print("Dataset loaded from " + DATASET_CACHE_PATH)
+	return dataset["X"], dataset["Y"]
+
+# Build a dataset of the concept extractor with build(elems, vocabulary, babelNetCache)
+# in DATASET_WORKERS processes (querying BabelNet first for the lemmas of the concepts
+# keys of the elements which are not in the cache, the processes only read it):
+def concept_extractor_dataset(build, vocabulary, keys):
+	def build_dataset(elems):
+		prefetch_lemmas(elems, keys)
+		# Save the cache with the new elements found from the queries:
+		babelNetCache.save()
+		return parallel_dataset(build, elems, vocabulary, ReadOnlyBabelNetCache(babelNetCache), n_workers=DATASET_WORKERS)
+	return build_dataset
+
+# Query BabelNet concurrently for the lemmas of the concepts "bn:--n" of the
+# elements which are not in the cache yet (instead of one query at a time
+# while building the dataset):
+def prefetch_lemmas(elems, keys):
+	babelNetIDs = set()
+	for elem in elems:
+		for key in keys:
+			c = elem[key].lower().strip()
+			if "bn:" in c and "::bn:" not in c and c.count("bn:") < 2:
+				babelNetID = c[c.index("bn:"):]
+				if babelNetCache.get(babelNetID) is None:
+					babelNetIDs.add(babelNetID)
+	if not babelNetIDs:
+		return
+
+	print("Querying BabelNet for " + str(len(babelNetIDs)) + " concepts")
+	babelNetClient = BabelNetClient(babelNetCache)
+	async def get_lemmas():
+		try:
+			return await babelNetClient.get_lemmas(babelNetIDs)
+		finally:
+			await babelNetClient.close()
+	lemmas = asyncio.run(get_lemmas())
+	print("Done (" + str(sum([1 for lemma in lemmas.values() if lemma is not None])) + " found).")
+
 ##### RELATION CLASSIFIER #####
 if TRAIN_RELATION_CLASSIFIER == True:
 	
 	print("Training relation classifier")
 
-	X = []
-	Y = []
-
-	cnt = 0
-	kb_len = int(len(knowledge_base) * hparams_relation_classifier["kbLenPercentage"])
-	print("Reading the knowledge base (" + str(kb_len) + " elements)")
-
-	# Build X and Y:
-	for elem in knowledge_base[:kb_len]:
-
-		cnt += 1
-		print("Progress: {:2.1%}".format(cnt / kb_len), end="\r")
-
-		X.append(relation_classifier_vocabulary.sentence2indices(elem["question"]))
-		Y.append(relation_to_int(elem["relation"]))
-
-	print("\nDone.")
+	X, Y = cached_dataset("relation_classifier", [hparams_relation_classifier["vocabularyPath"]],
+						  hparams_relation_classifier["kbLenPercentage"],
+						  lambda elems: relation_classifier_dataset(elems, relation_classifier_vocabulary))
 
 	# Relation to one hot enconding:
 	Y = keras.utils.np_utils.to_categorical(Y, 16)
 
 	# Add padding to X:
-	longest_sentence_length = max([len(sentence) for sentence in X])
-	X = keras.preprocessing.sequence.pad_sequences(sequences=X, maxlen=longest_sentence_length)
+	X = X.padded()
 
 	# Split training set into train, dev and test:
 	X_train, Y_train, X_dev, Y_dev, X_test, Y_test = split_dataset(X, Y, hparams_relation_classifier["kbSplit"])
@@ -163,126 +183,14 @@ if TRAIN_RELATION_CLASSIFIER == True:
 if TRAIN_CONCEPT_EXTRACTOR_QUESTION:
 	print("Training concept extractor for questions")
 
-	X = []
-	Y = []
+	X, Y = cached_dataset("concept_extractor_question", [hparams_concept_extractor_question["vocabularyPath"]],
+						  hparams_concept_extractor_question["kbLenPercentage"],
+						  concept_extractor_dataset(concept_extractor_question_dataset,
+													concept_extractor_question_vocabulary, ["c1", "c2"]))
 
-	cnt = 0
-	kb_len = int(len(knowledge_base) * hparams_concept_extractor_question["kbLenPercentage"])
-	print("Reading the knowledge base (" + str(kb_len) + " elements)")
-	
-	for elem in knowledge_base[:kb_len]:
-
-		cnt += 1
-		print("Progress: {:2.1%}".format(cnt / kb_len), end="\r")
-
-		question = elem["question"].lower().strip().rstrip()
-		c1 = elem["c1"].lower().strip().rstrip()
-		c2 = elem["c2"].lower().strip().rstrip()
-
-		c1_i1 = 0
-		c1_i2 = 0
-		c2_i1 = 0
-		c2_i2 = 0
-
-		# Concepts malformed:
-		if c1.count("bn:") >= 2 or c2.count("bn:") >= 2:
-			continue
-
-		# Get indices of c1:
-		if "::bn:" in c1: # case "w::bn:--n"
-			idx = c1.index("::bn:")
-			w = c1[:idx].strip().rstrip()
-
-			question_split = split_words_punctuation(question)
-			w_split = split_words_punctuation(w)
-
-			c1_i1 = find_pattern(question_split, w_split)
-			c1_i2 = c1_i1 + len(w_split) - 1
-		elif "bn:" in c1: # case "w::bn:--n"
-			try:
-				w = babelNetIdToLemma(c1[c1.index("bn:"):], babelNetCache)
-
-				question_split = split_words_punctuation(question)
-				w_split = split_words_punctuation(w)
-
-				c1_i1 = find_pattern(question_split, w_split)
-				c1_i2 = c1_i1 + len(w_split) - 1
-			except:
-				pass
-		elif c1 in question: # case "w"
-			question_split = split_words_punctuation(question)
-			w_split = split_words_punctuation(w)
-
-			c1_i1 = find_pattern(question_split, w_split)
-			c1_i2 = c1_i1 + len(w_split) - 1
-
-		# Get indices of c2:
-		if "::bn:" in c2: # case "w::bn:--n"
-			idx = c2.index("::bn:")
-			w = c2[:idx].strip().rstrip()
-
-			question_split = split_words_punctuation(question)
-			w_split = split_words_punctuation(w)
-
-			c2_i1 = find_pattern(question_split, w_split)
-			c2_i2 = c2_i1 + len(w_split) - 1
-		elif "bn:" in c2: # case "bn:--n"
-			try:
-				w = babelNetIdToLemma(c2[c2.index("bn:"):], babelNetCache)
-
-				question_split = split_words_punctuation(question)
-				w_split = split_words_punctuation(w)
-
-				c2_i1 = find_pattern(question_split, w_split)
-				c2_i2 = c2_i1 + len(w_split) - 1
-			except:
-				pass
-		elif c2 in question: # case "w"
-			question_split = split_words_punctuation(question)
-			w_split = split_words_punctuation(w)
-
-			c2_i1 = find_pattern(question_split, w_split)
-			c2_i2 = c2_i1 + len(w_split) - 1
-
-		# Create data for the NN:
-		x = concept_extractor_question_vocabulary.sentence2indices(question)
-		y = [[0, 0, 0, 0, 0, 0, 1] for _ in range(len(x))]
-
-		# The KB could be malformed, validate c1(2)_i2
-		c1_i2 = min(c2_i2, len(x)-1)
-		c2_i2 = min(c2_i2, len(x)-1)
-
-		# Begin and end of the concept,
-		# activation is (Begin+End, Begin (but not End), End (but not Begin), Other (not Begin nor End)):
-		if c1_i1 != -1 and c1_i2 != -1:
-			if c1_i1 == c1_i2:
-				y[c1_i1] = [1, 0, 0, 0, 0, 0, 0]
-			else:
-				y[c1_i1] = [0, 1, 0, 0, 0, 0, 0]
-				y[c1_i2] = [0, 0, 1, 0, 0 ,0, 0]
-
-		if c2_i1 != -1 and c2_i2 != -1:
-			if c2_i1 == c2_i2:
-				y[c2_i1] = [0, 0, 0, 1, 0, 0, 0]
-			else:
-				y[c2_i1] = [0, 0, 0, 0, 1, 0, 0]
-				y[c2_i2] = [0, 0, 0, 0, 0, 1, 0]
-
-		#print("question:", split_words_punctuation(question))
-		#print("y:", y)
-
-		X.append(x)
-		Y.append(y)
-
-	print("\nDone.")
-
-	# Save the cache with the new elements found from the queries:
-	babelNetCache.save()
-
-	# Add padding to X and Y:
-	longest_sentence_length = max([len(sentence) for sentence in X])
-	X = keras.preprocessing.sequence.pad_sequences(sequences=X, maxlen=longest_sentence_length)
-	Y = keras.preprocessing.sequence.pad_sequences(sequences=Y, maxlen=longest_sentence_length)
+	# Add padding to X and Y (labels to one hot encoding):
+	X = X.padded()
+	Y = labels_to_one_hot(Y.padded(value=-1), 7)
 
 	# Split training set into train, dev and test:
 	X_train, Y_train, X_dev, Y_dev, X_test, Y_test = split_dataset(X, Y, hparams_concept_extractor_question["kbSplit"])
@@ -321,104 +229,14 @@ if TRAIN_CONCEPT_EXTRACTOR_QUESTION:
 if TRAIN_CONCEPT_EXTRACTOR_ANSWER == True:
 	print("Training concept extractor for answers")
 
-	X = []
-	Y = []
+	X, Y = cached_dataset("concept_extractor_answer", [hparams_concept_extractor_answer["vocabularyPath"]],
+						  hparams_concept_extractor_answer["kbLenPercentage"],
+						  concept_extractor_dataset(concept_extractor_answer_dataset,
+													concept_extractor_answer_vocabulary, ["c2"]))
 
-	cnt = 0
-	kb_len = int(len(knowledge_base) * hparams_concept_extractor_answer["kbLenPercentage"])
-	print("Reading the knowledge base (" + str(kb_len) + " elements)")
-	
-	for elem in knowledge_base[:kb_len]:
-		
-		cnt += 1
-		print("Progress: {:2.1%}".format(cnt / kb_len), end="\r")
-		
-		answer = elem["answer"].strip().rstrip()
-		c2 = elem["c2"].strip().rstrip()
-		#print("Q:", question)
-		#print("A:", answer)
-		#print("c2:", c2)
-		if answer.lower() == "yes" or answer.lower() == "no":
-			# c1 and c2 can be determined directly inside the question
-			#print("c1 and c2 can be determined directly inside the question")
-			continue
-		elif c2.count("bn:") >= 2:
-			# c2 is malformed
-			#print("c2 is malformed")
-			continue
-		elif "::bn:" in c2: # case "w::bn:--n"
-			i = c2.index("::bn:")
-			w = c2[:i].strip().rstrip()
-			
-			answer_split = split_words_punctuation(answer)
-			w_split = split_words_punctuation(w)
-			
-			i1 = find_pattern(answer_split, w_split)
-			i2 = i1 + len(w_split) - 1
-		elif "bn:" in c2: # case "bn:--n"
-			try:
-				# TODO: note that using regex could help finding "bn:--n" better
-				#print("Case bn:--n")
-				#print(c2[c2.index("bn:"):])
-				w = babelNetIdToLemma(c2[c2.index("bn:"):], babelNetCache)
-				#print("w:", w)
-				
-				answer_split = split_words_punctuation(answer.lower())
-				w_split = split_words_punctuation(w.lower())
-				
-				# TODO: note that len(answer_split) could be less than len(w_split)
-				i1 = find_pattern(answer_split, w_split)
-				i2 = i1 + len(w_split) - 1
-			except Exception as e:
-				#print(str(e))
-				continue
-		elif c2.lower() in answer.lower(): # case "w"
-			answer_split = split_words_punctuation(answer)
-			c2_split = split_words_punctuation(c2)
-		
-			i1 = find_pattern(answer_split, c2_split)
-			i2 = i1 + len(c2_split) - 1
-		else:
-			continue
-
-		# Create data for the NN:
-		x = concept_extractor_answer_vocabulary.sentence2indices(answer)
-		y = [[0, 0, 0, 1] for _ in range(len(x))]
-
-		if i1 == -1 or i2 == -1:
-			#print("ERROR: index -1")
-			continue
-
-		# The KB could be malformed, validate i1 and i2:
-		i1 = max(i1, 0)
-		i2 = min(i2, len(x)-1)
-
-		#print("i1:", i1)
-		#print("i2:", i2)
-		
-		# Begin and end of the concept,
-		# activation is (Begin+End, Begin (but not End), End (but not Begin), Other (not Begin nor End)):
-		if i1 == i2:
-			y[i1] = [1, 0, 0, 0]
-		else:
-			y[i1] = [0, 1, 0, 0]
-			y[i2] = [0, 0, 1, 0]
-		
-		#print("x:", x)
-		#print("y:", y)
-	
-		X.append(x)
-		Y.append(y)
-
-	print("\nDone.")
-
-	# Save the cache with the new elements found from the queries:
-	babelNetCache.save()
-
-	# Add padding to X and Y:
-	longest_sentence_length = max([len(sentence) for sentence in X])
-	X = keras.preprocessing.sequence.pad_sequences(sequences=X, maxlen=longest_sentence_length)
-	Y = keras.preprocessing.sequence.pad_sequences(sequences=Y, maxlen=longest_sentence_length)
+	# Add padding to X and Y (labels to one hot encoding):
+	X = X.padded()
+	Y = labels_to_one_hot(Y.padded(value=-1), 4)
 
 	# Split training set into train, dev and test:
 	X_train, Y_train, X_dev, Y_dev, X_test, Y_test = split_dataset(X, Y, hparams_concept_extractor_answer["kbSplit"])
@@ -456,38 +274,28 @@ if TRAIN_CONCEPT_EXTRACTOR_ANSWER == True:
 if TRAIN_ANSWER_GENERATOR == True:
 	print("Training answer generator")
 
-	X = []
-	Y = []
-	
-	cnt = 0
-	kb_len = int(len(knowledge_base) * hparams_answer_generator["kbLenPercentage"])
-	print("Reading the knowledge base (" + str(kb_len) + " elements)")
-	
-	for elem in knowledge_base[:kb_len]:
-		cnt += 1
-		print("Progress: {:2.1%}".format(cnt / kb_len), end="\r")
-		
-		question = elem["question"].strip().rstrip()
-		answer = elem["answer"].strip().rstrip()
-
-		x = vocabulary_big.sentence2indices(question)
-		x.append(vocabulary_big.word2index[vocabulary_big.EOS_SYMBOL])
-		y = vocabulary_small.sentence2indices(answer)
-		y.append(vocabulary_small.word2index[vocabulary_small.EOS_SYMBOL])
-	
-		X.append(x)
-		Y.append(y)
-	
-	print("\nDone.")
+	X, Y = cached_dataset("answer_generator",
+						  [hparams_answer_generator["decoderVocabularyPath"], hparams_answer_generator["encoderVocabularyPath"]],
+						  hparams_answer_generator["kbLenPercentage"],
+						  lambda elems: answer_generator_dataset(elems, vocabulary_big, vocabulary_small))
 	
 	# Split training set into train, dev and test:
 	X_train, Y_train, X_dev, Y_dev, X_test, Y_test = split_dataset(X, Y, hparams_answer_generator["kbSplit"])
 	
-	# Create buckets:
+	# Most frequent words of the answers (used by the bot to decode faster):
+	save_shortlist(frequent_answer_ids(Y_train, SEQ2SEQ_SHORTLIST_SIZE,
+									   vocabulary_small.word2index[vocabulary_small.PAD_SYMBOL]), "../models/seq2seq_shortlist.json")
+
+	# Create buckets (each pair in the bucket of the length of its answer):
 	buckets_dims = [10, 20, 50, max([len(y) for y in Y])]
-	padded_bucket_x_train, padded_bucket_y_train = create_buckets(X_train, Y_train, buckets_dims)
-	padded_bucket_x_dev, padded_bucket_y_dev = create_buckets(X_dev, Y_dev, buckets_dims)
-	padded_bucket_x_test, padded_bucket_y_test = create_buckets(X_test, Y_test, buckets_dims)
+	pad_symbol_idx = vocabulary_small.word2index[vocabulary_small.PAD_SYMBOL]
+	batch_size = hparams_answer_generator["batchSize"]
+	train_batches = BucketSampler(X_train, Y_train, buckets_dims, batch_size, shuffle=True,
+								  prefetch=SEQ2SEQ_PREFETCH_BATCHES, pad_symbol_idx=pad_symbol_idx)
+	dev_batches = BucketSampler(X_dev, Y_dev, buckets_dims, batch_size, shuffle=False,
+								prefetch=SEQ2SEQ_PREFETCH_BATCHES, pad_symbol_idx=pad_symbol_idx)
+	test_batches = BucketSampler(X_test, Y_test, buckets_dims, batch_size, shuffle=False,
+								 prefetch=SEQ2SEQ_PREFETCH_BATCHES, pad_symbol_idx=pad_symbol_idx)
 
 	# Define the network:
 	emb_matrix_big = word2vec.createEmbeddingMatrix(vocabulary_big)
@@ -502,14 +310,14 @@ if TRAIN_ANSWER_GENERATOR == True:
 							word2vec.EMBEDDING_DIM, emb_matrix_big, emb_matrix_small,
 							vocabulary_small.word2index[vocabulary_small.PAD_SYMBOL],
 							hparams_answer_generator["nLayers"],
-							hparams_answer_generator["bidirectional"])
+							hparams_answer_generator["bidirectional"],
+							hparams_answer_generator.get("teacherForcing", True))
 	seq2seq_model = seq2seq_model.cuda() if torch.cuda.is_available() else seq2seq_model
 
 	# Train the network:
 	optimizer = torch.optim.RMSprop(seq2seq_model.parameters())
 	criterion = torch.nn.NLLLoss(ignore_index=seq2seq_model.embedding_padding_idx)
 	criterion = criterion.cuda() if torch.cuda.is_available() else criterion
-	batch_size = hparams_answer_generator["batchSize"]
 	starting_epoch = 0
 	starting_iter = 0
 	best_acc = 0
@@ -526,10 +334,9 @@ if TRAIN_ANSWER_GENERATOR == True:
 		seq2seq.utils.train(seq2seq_model,
 							optimizer,
 							criterion,
-							padded_bucket_x_train, padded_bucket_y_train,
-							batch_size=batch_size,
+							train_batches,
 							epochs=hparams_answer_generator["epochs"],
-							validation_data=[padded_bucket_x_dev, padded_bucket_y_dev],
+							validation_data=dev_batches,
 							checkpoint_dir="../models",
 							early_stopping_max=hparams_answer_generator["earlyStoppingMax"],
 							starting_epoch=starting_epoch,
@@ -537,5 +344,5 @@ if TRAIN_ANSWER_GENERATOR == True:
 							best_acc=best_acc)
 
 	# Test the network:
-	test_loss, test_accuracy = seq2seq.utils.evaluate(seq2seq_model, criterion, padded_bucket_x_test, padded_bucket_y_test, batch_size)
+	test_loss, test_accuracy = seq2seq.utils.evaluate(seq2seq_model, criterion, test_batches)
 	print("Test Loss: %2.3f | Test Accuracy: %2.3f%%" % (test_loss, test_accuracy*100))
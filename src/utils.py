@@ -2,25 +2,32 @@ import urllib.request, urllib.error, urllib.parse
 import urllib.request, urllib.parse, urllib.error
 import json
 import gzip
+import collections
+import functools
 from io import BytesIO
 
 import re
+import multiprocessing
+import os
 
 import numpy as np
 
 BABELNET_KEY  = "5aa541b8-e16d-4170-8e87-868c0bff9a5e"
 
+# Number of elements of the KB between two prints of the progress:
+PROGRESS_INTERVAL = 1000
+
 # Query to BabelNet to get the lemma of the BabelNetID:
 def babelNetIdToLemma(babelNetID, babelNetCache=None):
 	
-	# Check if babelNetID is already in the cache:
+	# Check if babelNetID is already in the cache (or if it can't be resolved):
 	if babelNetCache is not None:
-		try:
-			lemma = babelNetCache.cache[babelNetID]
+		lemma = babelNetCache.get(babelNetID)
+		if lemma is not None:
 			#print(babelNetID + " is in cache")
 			return lemma
-		except:
-			pass
+		if babelNetCache.is_negative(babelNetID):
+			raise LookupError(babelNetID + " can't be resolved by BabelNet")
 
 	params = {
 		"id" : babelNetID,
@@ -30,17 +37,24 @@ def babelNetIdToLemma(babelNetID, babelNetCache=None):
 	url = "https://babelnet.io/v4/getSynset?" + urllib.parse.urlencode(params)
 	request = urllib.request.Request(url)
 	request.add_header("Accept-encoding", "gzip")
-	response = urllib.request.urlopen(request)
 
-	if response.info().get("Content-Encoding") == "gzip":
-		buf = BytesIO(response.read())
-		f = gzip.GzipFile(fileobj=buf)
-		data = json.loads(f.read().decode("utf-8"))
-		w = str(data["senses"][0].get("lemma")).replace("_", " ")
+	try:
+		response = urllib.request.urlopen(request)
+
+		if response.info().get("Content-Encoding") == "gzip":
+			buf = BytesIO(response.read())
+			f = gzip.GzipFile(fileobj=buf)
+			data = json.loads(f.read().decode("utf-8"))
+			w = str(data["senses"][0].get("lemma")).replace("_", " ")
+	except Exception:
+		# Don't query again BabelNet for this babelNetID for a while:
+		if babelNetCache is not None:
+			babelNetCache.add_negative(babelNetID)
+		raise
 	
 	# Update the cache:
 	if babelNetCache is not None:
-		babelNetCache.cache[babelNetID] = w
+		babelNetCache.add(babelNetID, w)
 	
 	return w
 
@@ -48,33 +62,50 @@ def babelNetIdToLemma(babelNetID, babelNetCache=None):
 # concept_start and concept_end are the token indices
 # (concept_end is included), returns the babelNetID
 # if the disambiguation is available, the part of the
-# sentence containing the concept otherwise:
-def babelfy_disambiguate(sentence, concept_start, concept_end):
-	params = {
-		"text" : sentence,
-		"lang" : "EN",
-		"key"  : BABELNET_KEY
-	}
-
-	url = "https://babelfy.io/v1/disambiguate?" + urllib.parse.urlencode(params)
-	request = urllib.request.Request(url)
-	request.add_header("Accept-encoding", "gzip")
-	response = urllib.request.urlopen(request)
-
-	if response.info().get("Content-Encoding") == "gzip":
-		buf = BytesIO(response.read())
-		f = gzip.GzipFile(fileobj=buf)
-		data = json.loads(f.read().decode("utf-8"))
+# sentence containing the concept otherwise.
+# The results of Babelfy are read from/added to babelfyCache if specified:
+def babelfy_disambiguate(sentence, concept_start, concept_end, babelfyCache=None):
+	fragments = babelfyCache.get_fragments(sentence) if babelfyCache is not None else None
+
+	if fragments is None:
+		params = {
+			"text" : sentence,
+			"lang" : "EN",
+			"key"  : BABELNET_KEY
+		}
+
+		url = "https://babelfy.io/v1/disambiguate?" + urllib.parse.urlencode(params)
+		request = urllib.request.Request(url)
+		request.add_header("Accept-encoding", "gzip")
+		response = urllib.request.urlopen(request)
+
+		fragments = []
+		if response.info().get("Content-Encoding") == "gzip":
+			buf = BytesIO(response.read())
+			f = gzip.GzipFile(fileobj=buf)
+			fragments = babelfy_fragments(json.loads(f.read().decode("utf-8")))
+			if babelfyCache is not None:
+				babelfyCache.add_fragments(sentence, fragments)
+
+	return babelfy_span(sentence, fragments, concept_start, concept_end)
+
+# Return the list of (start, end, babelSynsetID) of the results of Babelfy:
+def babelfy_fragments(data):
+	fragments = []
+	for result in data:
+		tokenFragment = result.get("tokenFragment")
+		fragments.append((tokenFragment.get("start"), tokenFragment.get("end"), result.get("babelSynsetID")))
+	return fragments
+
+# Given the token fragments found by Babelfy in a sentence, returns the concept
+# between the token indices concept_start and concept_end (see babelfy_disambiguate):
+def babelfy_span(sentence, fragments, concept_start, concept_end):
+	#print("Babelfy disambiguation results:")
+	for tfStart, tfEnd, babelSynsetID in fragments:
+		#print(("\t" + str(tfStart) + "\t" + str(tfEnd)))
 		
-		#print("Babelfy disambiguation results:")
-		for result in data:
-			tokenFragment = result.get("tokenFragment")
-			tfStart = tokenFragment.get("start")
-			tfEnd = tokenFragment.get("end")
-			#print(("\t" + str(tfStart) + "\t" + str(tfEnd)))
-			
-			if tfStart == concept_start and tfEnd == concept_end:
-				return " ".join(sentence.split()[concept_start:concept_end+1]) + "::" + result.get("babelSynsetID")
+		if tfStart == concept_start and tfEnd == concept_end:
+			return " ".join(sentence.split()[concept_start:concept_end+1]) + "::" + babelSynsetID
 
 	return " ".join(sentence.split()[concept_start:concept_end+1])
 
@@ -180,9 +211,42 @@ def int_to_relation(integer):
 	return ["ACTIVITY", "COLOR", "GENERALIZATION", "HOW_TO_USE", "MATERIAL", "PART", "PLACE", "PURPOSE", "SHAPE",
 			"SIMILARITY", "SIZE", "SMELL", "SOUND", "SPECIALIZATION", "TASTE", "TIME"][integer]
 
+# Words and punctuation symbols of a sentence (tokens) and words separated by whitespaces:
+TOKEN_REGEX = re.compile(r"[\w]+|[^\s\w]")
+WORD_REGEX = re.compile(r"\S+")
+
+# Number of sentences whose tokenization is cached (e.g. the same message is
+# tokenized by every vocabulary and to map the concepts back to its words):
+TOKENIZE_CACHE_SIZE = 4096
+
+# Tokens of a sentence with their character offsets (start, end) and the index
+# of the word of sentence.split() containing them (tuples, shared by the callers):
+Tokenization = collections.namedtuple("Tokenization", ["tokens", "offsets", "word_indices"])
+
+# Tokenize a sentence reading it once (the last TOKENIZE_CACHE_SIZE sentences are cached):
+@functools.lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+def tokenize(sentence):
+	tokens = []
+	offsets = []
+	word_indices = []
+
+	# A token never contains whitespaces, so it's inside a single word:
+	words = WORD_REGEX.finditer(sentence)
+	word_index = -1
+	word_end = 0
+	for m in TOKEN_REGEX.finditer(sentence):
+		while m.start() >= word_end:
+			word_end = next(words).end()
+			word_index += 1
+		tokens.append(m.group())
+		offsets.append(m.span())
+		word_indices.append(word_index)
+
+	return Tokenization(tuple(tokens), tuple(offsets), tuple(word_indices))
+
 # Split a sentence into words and punctuation symbols:
 def split_words_punctuation(sentence):
-	return re.findall(r"[\w]+|[^\s\w]", sentence)
+	return list(tokenize(sentence).tokens)
 
 # Find a pattern p in s (O(|s|*|p|)),
 # since p is almost always small on avg. the
@@ -198,19 +262,41 @@ def find_pattern(s, p):
 			return i
 	return -1
 
+# Find many patterns in s at once, returns the same as [find_pattern(s, p) for p in patterns]:
+# the candidate starts of a pattern are found with list.index (the occurrences
+# of its first token) and the pattern is compared as a slice only there:
+def find_all_patterns(s, patterns):
+	s = s if isinstance(s, list) else list(s)
+
+	indices = []
+	for p in patterns:
+		p = p if isinstance(p, list) else list(p)
+		if len(p) == 0:
+			indices.append(0)
+			continue
+		i = -1
+		try:
+			while True:
+				i = s.index(p[0], i + 1)
+				if s[i:i+len(p)] == p:
+					break
+		except ValueError:
+			i = -1
+		indices.append(i)
+	return indices
+
+# Same as find_all_patterns for many sentences, patterns is the list of the patterns
+# of each sentence (e.g. the concepts of the elements of the KB):
+def find_patterns(sentences, patterns):
+	return [find_all_patterns(s, ps) for s, ps in zip(sentences, patterns)]
+
 # Recognize the correct domain given a list of domains using Levenshtein distance:
 def recognize_domain(domain_list, domain):
 	domain_list_lower = [elem.lower() for elem in domain_list]
 	domain_lower = domain.lower()
 
-	dmin_index = 0
-	dmin_v = levenshtein(domain_list_lower[0], domain_lower)
-
-	for i in range(1, len(domain_list_lower)):
-		d = levenshtein(domain_list_lower[i], domain_lower)
-		if d < dmin_v:
-			dmin_index = i
-			dmin_v = d
+	# First domain with the min. distance:
+	dmin_index = int(np.argmin(levenshtein_many(domain_lower, domain_list_lower)))
 
 	return domain_list[dmin_index]
 
@@ -236,3 +322,326 @@ def levenshtein(s, t):
 			v0[j] = v1[j]
 	
 	return v1[len(t)]
+
+
+# Levenshtein distance between query and every candidate using the bit-parallel
+# algorithm of Myers (as formulated by Hyyro), each candidate is processed in
+# O(len(candidate)) operations on integers of len(query) bits. If max_distance
+# is specified the computation of a candidate stops as soon as its distance
+# is greater than max_distance and max_distance+1 is returned for it:
+def levenshtein_many(query, candidates, max_distance=None):
+	distances = np.empty(len(candidates), dtype=np.int64)
+
+	m = len(query)
+	if m == 0:
+		for i, t in enumerate(candidates):
+			distances[i] = len(t)
+		if max_distance is not None:
+			np.minimum(distances, max_distance + 1, out=distances)
+		return distances
+
+	# Bitmask of the positions of every character in the query:
+	peq = {}
+	for i, c in enumerate(query):
+		peq[c] = peq.get(c, 0) | (1 << i)
+
+	full = (1 << m) - 1
+	last = 1 << (m - 1)
+
+	for i, t in enumerate(candidates):
+		n = len(t)
+		if max_distance is not None and abs(m - n) > max_distance:
+			distances[i] = max_distance + 1
+			continue
+
+		pv = full
+		mv = 0
+		score = m
+		for j, c in enumerate(t):
+			eq = peq.get(c, 0)
+			xv = eq | mv
+			xh = (((eq & pv) + pv) ^ pv) | eq
+			ph = mv | (~(xh | pv) & full)
+			mh = pv & xh
+			if ph & last:
+				score += 1
+			elif mh & last:
+				score -= 1
+			ph = ((ph << 1) | 1) & full
+			mh = (mh << 1) & full
+			pv = mh | (~(xv | ph) & full)
+			mv = ph & xv
+
+			# The distance can decrease at most by one for each remaining character:
+			if max_distance is not None and score - (n - j - 1) > max_distance:
+				score = max_distance + 1
+				break
+
+		distances[i] = score
+
+	return distances
+
+# Split dataset into training set (pSplit %), dev set
+# and test set (of equal dimension):
+def split_dataset(X, Y, pSplit):
+	X_train = X[:int(len(X) * pSplit)]
+	Y_train = Y[:int(len(Y) * pSplit)]
+	X_dev   = X[int(len(X) * pSplit):int(len(X) * (pSplit + 1) / 2)]
+	Y_dev   = Y[int(len(Y) * pSplit):int(len(Y) * (pSplit + 1) / 2)]
+	X_test  = X[int(len(X) * (pSplit + 1) / 2):]
+	Y_test  = Y[int(len(Y) * (pSplit + 1) / 2):]
+
+	return X_train, Y_train, X_dev, Y_dev, X_test, Y_test
+
+# Labels (array of ids, -1 for padding) to one hot encoding (padding to zeros):
+def labels_to_one_hot(labels, n_labels):
+	return (np.asarray(labels)[..., np.newaxis] == np.arange(n_labels)).astype(np.int32)
+
+# Encode the questions and the answers of the elements of the KB for the answer
+# generator (Seq2Seq), returns X (questions) and Y (answers) as lists of indices
+# of vocabulary_x and vocabulary_y ending with EOS:
+def answer_generator_dataset(knowledge_base, vocabulary_x, vocabulary_y):
+	X = []
+	Y = []
+
+	cnt = 0
+	print("Reading the knowledge base (" + str(len(knowledge_base)) + " elements)")
+
+	for elem in knowledge_base:
+		cnt += 1
+		print("Progress: {:2.1%}".format(cnt / len(knowledge_base)), end="\r")
+
+		question = elem["question"].strip().rstrip()
+		answer = elem["answer"].strip().rstrip()
+
+		x = vocabulary_x.sentence2indices(question)
+		x.append(vocabulary_x.word2index[vocabulary_x.EOS_SYMBOL])
+		y = vocabulary_y.sentence2indices(answer)
+		y.append(vocabulary_y.word2index[vocabulary_y.EOS_SYMBOL])
+
+		X.append(x)
+		Y.append(y)
+
+	print("\nDone.")
+
+	return X, Y
+
+# Encode the questions of the elements of the KB for the relation classifier,
+# returns X (questions as lists of indices of vocabulary) and Y (ids of the relations):
+def relation_classifier_dataset(knowledge_base, vocabulary):
+	X = []
+	Y = []
+
+	cnt = 0
+	print("Reading the knowledge base (" + str(len(knowledge_base)) + " elements)")
+
+	for elem in knowledge_base:
+		cnt += 1
+		print("Progress: {:2.1%}".format(cnt / len(knowledge_base)), end="\r")
+
+		X.append(vocabulary.sentence2indices(elem["question"]))
+		Y.append(relation_to_int(elem["relation"]))
+
+	print("\nDone.")
+
+	return X, Y
+
+# Label the concepts c1 and c2 in the questions of the elements of the KB for
+# the concept extractor, returns X (questions as lists of indices of vocabulary)
+# and Y (lists of the labels of the words of the questions), the labels are
+# 0: c1 Begin+End, 1: c1 Begin (but not End), 2: c1 End (but not Begin),
+# 3-5: the same for c2, 6: Other:
+def concept_extractor_question_dataset(knowledge_base, vocabulary, babelNetCache=None, verbose=True):
+	X = []
+	Y = []
+
+	cnt = 0
+	if verbose:
+		print("Reading the knowledge base (" + str(len(knowledge_base)) + " elements)")
+
+	for elem in knowledge_base:
+
+		cnt += 1
+		if verbose and (cnt % PROGRESS_INTERVAL == 0 or cnt == len(knowledge_base)):
+			print("Progress: {:2.1%}".format(cnt / len(knowledge_base)), end="\r")
+
+		question = elem["question"].lower().strip().rstrip()
+		c1 = elem["c1"].lower().strip().rstrip()
+		c2 = elem["c2"].lower().strip().rstrip()
+
+		# Concepts malformed:
+		if c1.count("bn:") >= 2 or c2.count("bn:") >= 2:
+			continue
+
+		concepts_split = []
+		for c in [c1, c2]:
+			c_split = None
+			if "::bn:" in c: # case "w::bn:--n"
+				idx = c.index("::bn:")
+				w = c[:idx].strip().rstrip()
+				c_split = split_words_punctuation(w)
+			elif "bn:" in c: # case "bn:--n"
+				try:
+					w = babelNetIdToLemma(c[c.index("bn:"):], babelNetCache)
+					c_split = split_words_punctuation(w)
+				except:
+					pass
+			elif c in question: # case "w"
+				c_split = split_words_punctuation(c)
+			concepts_split.append(c_split)
+
+		# Get indices of c1 and c2 (0 if not searched) reading the question once:
+		c1_split, c2_split = concepts_split
+		if c1_split is not None or c2_split is not None:
+			indices = find_all_patterns(split_words_punctuation(question),
+										[c_split for c_split in concepts_split if c_split is not None])
+		c1_i1 = indices[0] if c1_split is not None else 0
+		c1_i2 = c1_i1 + len(c1_split) - 1 if c1_split is not None else 0
+		c2_i1 = indices[-1] if c2_split is not None else 0
+		c2_i2 = c2_i1 + len(c2_split) - 1 if c2_split is not None else 0
+
+		# Create data for the NN:
+		x = vocabulary.sentence2indices(question)
+		y = [6 for _ in range(len(x))]
+
+		# The KB could be malformed, validate c1(2)_i2
+		c1_i2 = min(c2_i2, len(x)-1)
+		c2_i2 = min(c2_i2, len(x)-1)
+
+		# Begin and end of the concept:
+		if c1_i1 != -1 and c1_i2 != -1:
+			if c1_i1 == c1_i2:
+				y[c1_i1] = 0
+			else:
+				y[c1_i1] = 1
+				y[c1_i2] = 2
+
+		if c2_i1 != -1 and c2_i2 != -1:
+			if c2_i1 == c2_i2:
+				y[c2_i1] = 3
+			else:
+				y[c2_i1] = 4
+				y[c2_i2] = 5
+
+		X.append(x)
+		Y.append(y)
+
+	if verbose:
+		print("\nDone.")
+
+	return X, Y
+
+# Label the concept c2 in the answers of the elements of the KB for the concept
+# extractor, returns X (answers as lists of indices of vocabulary) and Y (lists of
+# the labels of the words of the answers), the labels are 0: Begin+End,
+# 1: Begin (but not End), 2: End (but not Begin), 3: Other:
+def concept_extractor_answer_dataset(knowledge_base, vocabulary, babelNetCache=None, verbose=True):
+	X = []
+	Y = []
+
+	cnt = 0
+	if verbose:
+		print("Reading the knowledge base (" + str(len(knowledge_base)) + " elements)")
+
+	for elem in knowledge_base:
+
+		cnt += 1
+		if verbose and (cnt % PROGRESS_INTERVAL == 0 or cnt == len(knowledge_base)):
+			print("Progress: {:2.1%}".format(cnt / len(knowledge_base)), end="\r")
+
+		answer = elem["answer"].strip().rstrip()
+		c2 = elem["c2"].strip().rstrip()
+		if answer.lower() == "yes" or answer.lower() == "no":
+			# c1 and c2 can be determined directly inside the question
+			continue
+		elif c2.count("bn:") >= 2:
+			# c2 is malformed
+			continue
+		elif "::bn:" in c2: # case "w::bn:--n"
+			i = c2.index("::bn:")
+			w = c2[:i].strip().rstrip()
+
+			answer_split = split_words_punctuation(answer)
+			c2_split = split_words_punctuation(w)
+		elif "bn:" in c2: # case "bn:--n"
+			try:
+				# TODO: note that using regex could help finding "bn:--n" better
+				w = babelNetIdToLemma(c2[c2.index("bn:"):], babelNetCache)
+
+				# TODO: note that len(answer_split) could be less than len(c2_split)
+				answer_split = split_words_punctuation(answer.lower())
+				c2_split = split_words_punctuation(w.lower())
+			except Exception as e:
+				continue
+		elif c2.lower() in answer.lower(): # case "w"
+			answer_split = split_words_punctuation(answer)
+			c2_split = split_words_punctuation(c2)
+		else:
+			continue
+
+		i1 = find_all_patterns(answer_split, [c2_split])[0]
+		i2 = i1 + len(c2_split) - 1
+
+		# Create data for the NN:
+		x = vocabulary.sentence2indices(answer)
+		y = [3 for _ in range(len(x))]
+
+		if i1 == -1 or i2 == -1:
+			continue
+
+		# The KB could be malformed, validate i1 and i2:
+		i1 = max(i1, 0)
+		i2 = min(i2, len(x)-1)
+
+		# Begin and end of the concept:
+		if i1 == i2:
+			y[i1] = 0
+		else:
+			y[i1] = 1
+			y[i2] = 2
+
+		X.append(x)
+		Y.append(y)
+
+	if verbose:
+		print("\nDone.")
+
+	return X, Y
+
+# Build a dataset with build(knowledge_base, *args, verbose=False) (e.g.
+# concept_extractor_question_dataset) in n_workers processes (all the cores
+# by default): the KB is split into shards of shard_size elements, built in
+# parallel and merged in order, so X and Y are the same as build's ones.
+# The arguments are shared with the workers (copy-on-write where processes
+# are forked), so a BabelNetCache should be read-only (see ReadOnlyBabelNetCache):
+def parallel_dataset(build, knowledge_base, *args, n_workers=None, shard_size=1000):
+	n_workers = n_workers if n_workers is not None else os.cpu_count()
+	shards = [(start, min(start + shard_size, len(knowledge_base))) for start in range(0, len(knowledge_base), shard_size)]
+	if n_workers <= 1 or len(shards) <= 1:
+		return build(knowledge_base, *args)
+
+	X = []
+	Y = []
+
+	print("Reading the knowledge base (" + str(len(knowledge_base)) + " elements, " + str(n_workers) + " processes)")
+	methods = multiprocessing.get_all_start_methods()
+	context = multiprocessing.get_context("fork" if "fork" in methods else None)
+	with context.Pool(n_workers, _init_dataset_worker, (build, knowledge_base, args)) as pool:
+		for (start, end), (x, y) in zip(shards, pool.imap(_build_dataset_shard, shards)):
+			X += x
+			Y += y
+			print("Progress: {:2.1%}".format(end / len(knowledge_base)), end="\r")
+	print("\nDone.")
+
+	return X, Y
+
+# State of the processes of parallel_dataset:
+_dataset_worker = None
+
+def _init_dataset_worker(build, knowledge_base, args):
+	global _dataset_worker
+	_dataset_worker = (build, knowledge_base, args)
+
+def _build_dataset_shard(shard):
+	build, knowledge_base, args = _dataset_worker
+	return build(knowledge_base[shard[0]:shard[1]], *args, verbose=False)
@@ -1,11 +1,10 @@
-import json
 import sys
 from utils import split_words_punctuation
+from CompactKnowledgeBase import CompactKnowledgeBase
 
 
 # Open the Knowledge Base:
-with open("../resources/kb.json") as kb_file:
-	knowledge_base = json.load(kb_file)
+knowledge_base = CompactKnowledgeBase("../resources/kb.json")
 
 # Number of minimum counts to include a word
 # in the vocabulary: